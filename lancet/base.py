@@ -1,10 +1,14 @@
+import os
 import shlex
+import hashlib
 
 import attr
 import click
 
 from .utils import cached_property, taskstatus
-from .git import Repository
+from .git import Repository, CredentialsCallbacks, get_common_dir
+from .deadline import Deadline
+from .settings import LOCAL_CONFIG
 
 
 class NullIntegrationHelper:
@@ -57,6 +61,7 @@ class Lancet:
     config = attr.ib()
     integration_helper = attr.ib()
     call_on_close = attr.ib(default=lambda: None)
+    deadline = attr.ib(default=attr.Factory(Deadline))
 
     def defer_to_shell(self, *args, **kwargs):
         return self.integration_helper.register(*args, **kwargs)
@@ -77,11 +82,12 @@ class Lancet:
                         url
                     )
                 )
-                if not username:
-                    username = click.prompt("Username")
-                else:
-                    click.echo("Username: {}".format(username))
-                password = click.prompt("Password", hide_input=True)
+                with self.deadline.paused():
+                    if not username:
+                        username = click.prompt("Username")
+                    else:
+                        click.echo("Username: {}".format(username))
+                    password = click.prompt("Password", hide_input=True)
 
                 if checker:
                     with taskstatus("Checking provided credentials") as ts:
@@ -95,6 +101,18 @@ class Lancet:
                 self.keyring.set_password(key, username, password)
                 return url, username, password
 
+    def get_cache_path(self, *parts):
+        cache_dir = os.path.expanduser(self.config.get("lancet", "cache_dir"))
+        path = os.path.join(cache_dir, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def get_repo_cache_path(self, filename):
+        """Return the path of a cache file for the current repository."""
+        common_dir = os.path.realpath(get_common_dir(self.repo))
+        digest = hashlib.sha1(common_dir.encode("utf-8")).hexdigest()[:12]
+        return self.get_cache_path("repositories", digest, filename)
+
     def get_config_section(self, key):
         section = self.config.get("lancet", key)
         section = f"{key}:{section}"
@@ -108,11 +126,60 @@ class Lancet:
         section = self.get_config_section(key)
         return self.get_instance_from_config(section, "factory", self, section)
 
+    @cached_property
+    def transport(self):
+        from .transport import from_config
+
+        transport = from_config(
+            self.config, self.deadline, self.get_cache_path("latencies.json")
+        )
+        self.call_on_close(transport.close)
+        return transport
+
+    @cached_property
+    def response_cache(self):
+        from .http_cache import ResponseCache
+
+        return ResponseCache(
+            self.get_cache_path("http", ""),
+            self.config.getint("lancet", "http_cache_size") * 1024 * 1024,
+        )
+
+    def get_remote_callbacks(self):
+        return CredentialsCallbacks(self.deadline)
+
     @cached_property
     def repo(self):
         # TODO: Make path more dynamic
         return Repository("./.git")
 
+    @cached_property
+    def worktree_pool(self):
+        if not self.config.getboolean("repository", "use_worktrees"):
+            return None
+
+        from .worktrees import WorktreePool
+
+        directory = self.config.get("repository", "worktree_dir")
+        if directory:
+            directory = os.path.expanduser(directory)
+        else:
+            directory = self.get_cache_path("worktrees")
+
+        # The project configuration and the virtual environment are not
+        # tracked, but are needed by the commands run in the worktrees.
+        linked_paths = [LOCAL_CONFIG]
+        virtualenv = self.config.get("lancet", "virtualenv", fallback=None)
+        if virtualenv and not os.path.isabs(os.path.expanduser(virtualenv)):
+            linked_paths.append(os.path.normpath(virtualenv))
+
+        return WorktreePool(
+            self.repo,
+            directory,
+            self.config.getint("repository", "max_worktrees"),
+            linked_paths,
+        )
+
     @cached_property
     def keyring(self):
         return self._load_from_configurable_factory("keyring")
@@ -125,6 +192,21 @@ class Lancet:
     def tracker(self):
         return self._load_from_configurable_factory("tracker")
 
+    @cached_property
+    def tracker_queue(self):
+        if not self.config.getboolean("tracker", "write_behind"):
+            return None
+
+        from .tracker_queue import TrackerQueue
+
+        # Each tracker instance gets its own journal, as the flusher replays
+        # the intents using the configuration of the current project.
+        url = self.config.get(self.get_config_section("tracker"), "url")
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+        queue = TrackerQueue(self.get_cache_path(f"tracker-{digest}.jsonl"))
+        self.call_on_close(queue.flush_in_background)
+        return queue
+
     @cached_property
     def timer(self):
         return self._load_from_configurable_factory("timer")
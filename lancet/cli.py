@@ -2,6 +2,7 @@ import os
 import sys
 import bdb
 import importlib
+import logging
 import shlex
 import subprocess
 
@@ -18,6 +19,8 @@ from . import __version__
 from .settings import load_config, diff_config, as_dict
 from .settings import PROJECT_CONFIG, DEFAULT_CONFIG
 from .base import Lancet, WarnIntegrationHelper, ShellIntegrationHelper
+from .deadline import Deadline
+from .helpers import report_tracker_queue
 from .utils import hr
 
 
@@ -160,7 +163,7 @@ class ConfigurableLoader(click.Group):
     default=False,
     help=(
         "Drop into the debugger if the command execution raises "
-        "an exception."
+        "an exception, and show the network statistics."
     ),
 )
 @click.option(
@@ -173,11 +176,9 @@ class ConfigurableLoader(click.Group):
 )
 @click.pass_context
 def main(ctx, debug):
-    # TODO: Enable this using a command line switch
-    # import logging
-    # logging.basicConfig(level=logging.DEBUG)
-
     if debug:
+        logging.basicConfig(format="%(name)s: %(message)s")
+        logging.getLogger("lancet").setLevel(logging.DEBUG)
 
         def exception_handler(type, value, traceback):
             click.secho(
@@ -217,7 +218,10 @@ def main(ctx, debug):
         config = load_config()
 
     ctx.obj = Lancet(
-        config, integration_helper, call_on_close=ctx.call_on_close
+        config,
+        integration_helper,
+        call_on_close=ctx.call_on_close,
+        deadline=Deadline(config.getfloat("lancet", "command_timeout")),
     )
     ctx.call_on_close(integration_helper.close)
 
@@ -268,6 +272,10 @@ def main(ctx, debug):
 
             sys.excepthook = exception_handler
 
+    # Hidden commands are mostly used by shell hooks; do not clutter them.
+    if not (ctx.invoked_subcommand or "").startswith("_"):
+        report_tracker_queue(ctx.obj)
+
 
 @main.command(name="_setup_helper")
 def _setup_helper():
@@ -372,12 +380,9 @@ def _autocomplete(ctx, shell):
 # TODO:
 # * review
 #     pull
-#     ci-status
 #     pep8
 #     diff
 #     mergeability (rebase is of the submitter responsibility)
-# * merge
-#     pull, merge, delete
 # * issues
 #     list all open/assigned issues (or by filter)
 # * comment
@@ -46,3 +46,11 @@ def issue_add(lancet, assign, add_to_sprint, summary):
             username = assign
         active_status = lancet.config.get("tracker", "active_status")
         assign_issue(lancet, issue, username, active_status)
+
+
+@click.command()
+@click.pass_obj
+def _flush_tracker_queue(lancet):
+    """Replay the queued issue tracker updates."""
+    if lancet.tracker_queue is not None:
+        lancet.tracker_queue.flush(lancet.tracker)
@@ -1,13 +1,43 @@
+import sys
+import time
+import datetime
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
 import click
+import pygit2
+from tabulate import tabulate
+from gitlab.exceptions import GitlabError
 
-from ..scm_manager import PullRequestAlreadyExists
-from ..utils import taskstatus, edit_template
+from ..git import (
+    push,
+    PushRejected,
+    iter_references,
+    merge_in_memory,
+    MergeBaseCache,
+)
+from ..ratelimit import get_poll_interval
+from ..scm_manager import PullRequestAlreadyExists, get_project_path
+from ..utils import (
+    taskstatus,
+    edit_template,
+    get_template_variables,
+    run_in_background,
+)
 from ..helpers import (
     get_issue,
     get_transition,
     set_issue_status,
     get_branch,
     assign_pull_request,
+    checkout_branch,
+    find_local_branch,
+    get_issue_keys,
+    get_issue_index,
+    get_project_remotes,
+    check_mergeability,
+    fetch_branches,
+    abort_on_conflicts,
 )
 
 
@@ -28,8 +58,14 @@ from ..helpers import (
     help="Opens the link with the pull request.",
 )
 @click.option("-a", "--assign")
+@click.option(
+    "-c",
+    "--check/--no-check",
+    default=True,
+    help="Checks that the branch merges cleanly into the base branch.",
+)
 @click.pass_context
-def pull_request(ctx, base_branch, open_pr, stop_timer, assign):
+def pull_request(ctx, base_branch, open_pr, stop_timer, assign, check):
     """Create a new pull request for this issue."""
     lancet = ctx.obj
 
@@ -54,9 +90,8 @@ def pull_request(ctx, base_branch, open_pr, stop_timer, assign):
         if lancet.tracker.whoami() not in issue.assignees:
             ts.abort("Issue currently not assigned to you")
 
-        # TODO: Check mergeability
-
-    # TODO: Check remote status (PR does not already exist)
+    if check:
+        check_mergeability(lancet, branch, base_branch)
 
     # Push to remote
     with taskstatus('Pushing to "{}"', remote_name) as ts:
@@ -64,35 +99,31 @@ def pull_request(ctx, base_branch, open_pr, stop_timer, assign):
         if not remote:
             ts.abort('Remote "{}" not found', remote_name)
 
-        from ..git import CredentialsCallbacks
-
-        remote.push([branch.name], callbacks=CredentialsCallbacks())
-
-        ts.ok('Pushed latest changes to "{}"', remote_name)
-
-    # Create pull request
-    with taskstatus("Creating pull request") as ts:
-        template_path = lancet.config.get("repository", "pr_template")
-        message = edit_template(template_path, issue=issue)
-
-        if not message:
-            ts.abort("You didn't provide a title for the pull request")
-
-        title, body = message.split("\n", 1)
-        title = title.strip()
-
-        if not title:
-            ts.abort("You didn't provide a title for the pull request")
-
         try:
-            pr = lancet.scm_manager.create_pull_request(
-                branch.branch_name, base_branch, title, body.strip("\n")
+            pushed = push(
+                lancet.repo,
+                remote,
+                [branch.name],
+                lancet.get_remote_callbacks(),
             )
-        except PullRequestAlreadyExists as e:
-            pr = e.pull_request
+        except PushRejected as e:
+            ts.abort("{}", e.message)
+        if pushed:
+            ts.ok('Pushed latest changes to "{}"', remote_name)
+        else:
+            ts.ok('"{}" is already up to date', remote_name)
+
+    with taskstatus("Looking for an existing pull request") as ts:
+        pr = lancet.scm_manager.get_pull_request(
+            branch.branch_name, base_branch
+        )
+        if pr is not None:
             ts.ok("Pull request does already exist at {}", pr.link)
         else:
-            ts.ok("Pull request created at {}", pr.link)
+            ts.ok("No pull request open yet")
+
+    if pr is None:
+        pr = create_pull_request(lancet, issue, branch, base_branch)
 
     # Update issue
     set_issue_status(lancet, issue, review_status, transition)
@@ -102,9 +133,8 @@ def pull_request(ctx, base_branch, open_pr, stop_timer, assign):
             username = lancet.tracker.whoami()
         else:
             username = assign
-        assign_pull_request(lancet, issue, username)
+        assign_pull_request(lancet, pr, username)
 
-    # TODO: Also assign the PR?
     # TODO: Post to Slack?
 
     # Stop harvest timer
@@ -118,6 +148,46 @@ def pull_request(ctx, base_branch, open_pr, stop_timer, assign):
         click.launch(pr.link)
 
 
+def create_pull_request(lancet, issue, branch, base_branch):
+    template_path = lancet.config.get("repository", "pr_template")
+
+    # Indexing the history is only worth it if the template lists commits
+    commits = []
+    if "commits" in get_template_variables(template_path):
+        with taskstatus("Looking up the commits of the issue") as ts:
+            commits = get_issue_index(lancet).get_commits(
+                lancet.repo, get_issue_keys(lancet, issue.id)
+            )
+            ts.ok("Found {} commits related to {}", len(commits), issue.id)
+
+    # Create pull request
+    with taskstatus("Creating pull request") as ts:
+        with lancet.deadline.paused():
+            message = edit_template(
+                template_path, issue=issue, commits=commits
+            )
+
+        if not message:
+            ts.abort("You didn't provide a title for the pull request")
+
+        title, body = message.split("\n", 1)
+        title = title.strip()
+
+        if not title:
+            ts.abort("You didn't provide a title for the pull request")
+
+        try:
+            pr = lancet.scm_manager.create_pull_request(
+                branch.branch_name, base_branch, title, body.strip("\n")
+            )
+        except PullRequestAlreadyExists as e:
+            pr = e.pull_request
+            ts.ok("Pull request does already exist at {}", pr.link)
+        else:
+            ts.ok("Pull request created at {}", pr.link)
+    return pr
+
+
 @click.command()
 @click.option(
     "-f",
@@ -133,13 +203,523 @@ def checkout(lancet, force, issue):
 
     It is an error if the branch does no exist yet.
     """
-    issue = get_issue(lancet, issue)
+    # Existing local branches are found without contacting the tracker
+    branch = find_local_branch(lancet, issue)
+    found_locally = branch is not None
 
-    # Get the working branch
-    branch = get_branch(lancet, issue, create=force)
+    if not found_locally:
+        issue = get_issue(lancet, issue)
+        branch = get_branch(lancet, issue, create=force)
 
     with taskstatus("Checking out working branch") as ts:
         if not branch:
             ts.abort("Working branch not found")
-        lancet.repo.checkout(branch.name)
-        ts.ok('Checked out "{}"', branch.name)
+        path = checkout_branch(lancet, branch)
+        if path:
+            ts.ok('Switched to the worktree at "{}"', path)
+        else:
+            ts.ok('Checked out "{}"', branch.name)
+
+    if found_locally:
+        # Follow changes to the issue summary without waiting for them; the
+        # rename can only race with the checkout once it is done.
+        run_in_background("_sync-branch-name", branch.branch_name)
+
+
+@click.command()
+@click.argument("branch_name")
+@click.pass_obj
+def _sync_branch_name(lancet, branch_name):
+    """Rename a working branch to match the summary of its issue."""
+    branch = lancet.repo.lookup_branch(branch_name)
+    if branch is None:
+        return
+
+    name_getter = lancet.get_instance_from_config(
+        "repository", "branch_name_getter", lancet
+    )
+    issue = lancet.tracker.get_issue(
+        lancet.config.get("tracker", "project_id"),
+        name_getter.get_issue_key(branch_name),
+    )
+    _, full_name = name_getter(issue)
+    if full_name != branch_name:
+        branch.rename(full_name)
+
+
+@click.command()
+@click.option(
+    "-d",
+    "--delete-closed",
+    is_flag=True,
+    help="Deletes the branches of closed issues, locally and remotely.",
+)
+@click.pass_obj
+def branches(lancet, delete_closed):
+    """List the local branches along with the status of their issues."""
+    project_id = lancet.config.get("tracker", "project_id")
+    remote_name = lancet.config.get("repository", "remote_name")
+    name_getter = lancet.get_instance_from_config(
+        "repository", "branch_name_getter", lancet
+    )
+
+    issue_keys = {}
+    for ref_name in iter_references(lancet.repo, "refs/heads/"):
+        branch_name = ref_name[len("refs/heads/") :]
+        issue_keys[branch_name] = name_getter.match_issue_key(branch_name)
+
+    with taskstatus("Looking up issues on the issue tracker") as ts:
+        keys = sorted({k for k in issue_keys.values() if k is not None})
+        issues = {
+            str(issue.id): issue
+            for issue in lancet.tracker.get_issues(project_id, keys)
+        }
+        ts.ok("Retrieved {} issues", len(issues))
+
+    def get_issue(issue_key):
+        if issue_key is None:
+            return None
+        return issues.get(issue_key) or issues.get(f"{project_id}-{issue_key}")
+
+    if lancet.repo.head_is_detached or lancet.repo.head_is_unborn:
+        current_branch = None
+    else:
+        current_branch = lancet.repo.head.shorthand
+
+    table = []
+    closed = []
+    for branch_name, issue_key in issue_keys.items():
+        issue = get_issue(issue_key)
+        if issue is None:
+            status = "" if issue_key is None else "not found"
+            summary = ""
+        else:
+            status = issue.status or ""
+            summary = issue.summary
+            if len(summary) > 40:
+                summary = summary[:40] + "..."
+            if issue.is_closed:
+                status = click.style(status or "closed", fg="red")
+                # Names only matching through an empty prefix (e.g.
+                # "2024-cleanup") may not be issue branches at all, and
+                # branches checked out here or in another worktree cannot
+                # be deleted.
+                branch = lancet.repo.lookup_branch(branch_name)
+                key = name_getter.match_issue_key(branch_name, strict=True)
+                if key and not branch.is_checked_out():
+                    closed.append(branch_name)
+        table.append(
+            [
+                "*" if branch_name == current_branch else "",
+                branch_name,
+                issue_key or "",
+                status,
+                summary,
+            ]
+        )
+
+    click.echo()
+    headers = ["", "Branch", "Issue", "Status", "Summary"]
+    click.echo(tabulate(table, headers, tablefmt="simple"))
+    click.echo()
+
+    if not delete_closed or not closed:
+        return
+
+    click.echo("Branches of closed issues:")
+    for name in closed:
+        click.echo(" {} {}".format(click.style("*", fg="red"), name))
+    click.echo()
+    with lancet.deadline.paused():
+        confirmed = click.confirm(
+            "Delete these {} branches, locally and remotely?".format(
+                len(closed)
+            )
+        )
+    if not confirmed:
+        return
+
+    # All the remote branches are deleted at once, with a single push
+    with taskstatus('Deleting branches from "{}"', remote_name) as ts:
+        remote = lancet.repo.lookup_remote(remote_name)
+        if not remote:
+            ts.abort('Remote "{}" not found', remote_name)
+        try:
+            deleted = push(
+                lancet.repo,
+                remote,
+                [":refs/heads/" + name for name in closed],
+                lancet.get_remote_callbacks(),
+            )
+        except PushRejected as e:
+            # Branches still on the remote are kept locally as well
+            ts.fail("{}", e.message)
+            closed = [
+                name
+                for name in closed
+                if "refs/heads/" + name not in e.rejected
+            ]
+        else:
+            ts.ok('Deleted {} branches from "{}"', len(deleted), remote_name)
+
+    for name in closed:
+        with taskstatus('Deleting local branch "{}"', name) as ts:
+            try:
+                lancet.repo.lookup_branch(name).delete()
+            except pygit2.GitError as e:
+                ts.fail('Could not delete "{}": {}', name, e)
+            else:
+                ts.ok('Deleted "{}"', name)
+
+
+@click.command()
+@click.argument("issue")
+@click.pass_obj
+def log(lancet, issue):
+    """
+    List the commits related to the given issue, across all branches.
+
+    Commits are related to an issue if they mention it in their message or
+    if they were made on its working branch.
+    """
+    index = get_issue_index(lancet)
+    commits = index.get_commits(lancet.repo, get_issue_keys(lancet, issue))
+
+    if not commits:
+        click.echo("No commits found for issue {}".format(issue))
+        return
+
+    for commit in commits:
+        date = datetime.datetime.fromtimestamp(commit.commit_time)
+        click.echo(
+            "{} {} {} {}".format(
+                click.style(str(commit.id)[:10], fg="yellow"),
+                date.strftime("%Y-%m-%d"),
+                click.style(commit.author.name, fg="blue"),
+                commit.message.split("\n", 1)[0],
+            )
+        )
+
+
+JOB_STATUS_COLORS = {
+    "success": "green",
+    "failed": "red",
+    "running": "yellow",
+    "pending": "cyan",
+    "canceled": "magenta",
+}
+
+
+def render_pipeline_changes(status, seen):
+    """
+    Print the pipeline and the jobs whose status changed since they were
+    last printed. ``seen`` maps the printed objects to their status.
+    """
+    pipeline = status.pipeline
+    key = (status.branch, "pipeline", pipeline["id"])
+    if seen.get(key) != pipeline["status"]:
+        seen[key] = pipeline["status"]
+        click.echo(
+            "{}: pipeline #{} {} ({})".format(
+                click.style(status.branch, bold=True),
+                pipeline["id"],
+                click.style(
+                    pipeline["status"],
+                    fg=JOB_STATUS_COLORS.get(pipeline["status"]),
+                ),
+                pipeline["web_url"],
+            )
+        )
+
+    for job in sorted(status.jobs, key=lambda j: j["id"]):
+        key = (status.branch, "job", job["id"])
+        if seen.get(key) == job["status"]:
+            continue
+        seen[key] = job["status"]
+        click.echo(
+            "  {} › {}: {}".format(
+                job["stage"],
+                job["name"],
+                click.style(
+                    job["status"], fg=JOB_STATUS_COLORS.get(job["status"])
+                ),
+            )
+        )
+
+
+@click.command()
+@click.option(
+    "--base", "-b", "base_branch", help="Target branch of the pull requests."
+)
+@click.option(
+    "-w",
+    "--watch",
+    is_flag=True,
+    help="Keeps polling until all the pipelines are finished.",
+)
+@click.argument("branches", nargs=-1)
+@click.pass_obj
+def ci_status(lancet, base_branch, watch, branches):
+    """
+    Show the status of the CI pipelines of the pull requests of the given
+    branches (defaults to the current branch).
+    """
+    if not base_branch:
+        base_branch = lancet.config.get("repository", "base_branch")
+    if not branches:
+        branches = [lancet.repo.head.shorthand]
+
+    min_interval = lancet.config.getfloat("repository", "ci_poll_interval")
+    max_interval = lancet.config.getfloat("repository", "ci_max_poll_interval")
+    interval = min_interval
+    seen = {}
+
+    def get_status(branch):
+        return lancet.scm_manager.get_pipeline_status(branch, base_branch)
+
+    # All the branches are polled at once, over the shared connection pool
+    with ThreadPoolExecutor(len(branches)) as executor:
+        while True:
+            # Each polling round gets the full time budget
+            lancet.deadline.restart()
+            statuses = list(executor.map(get_status, branches))
+
+            for branch, status in zip(branches, statuses):
+                if status is not None:
+                    render_pipeline_changes(status, seen)
+                elif (branch, None) not in seen:
+                    seen[(branch, None)] = True
+                    click.echo(
+                        "{}: no pipeline found".format(
+                            click.style(branch, bold=True)
+                        )
+                    )
+
+            statuses = [s for s in statuses if s is not None]
+            running = [s for s in statuses if not s.is_finished]
+            if not watch or not running:
+                break
+
+            remaining = [s.remaining for s in running]
+            remaining = [r for r in remaining if r is not None]
+            interval = get_poll_interval(
+                interval,
+                any(s.changed for s in statuses),
+                min(remaining) if remaining else None,
+                min_interval,
+                max_interval,
+            )
+            time.sleep(interval)
+
+    failed = [s for s in statuses if s.pipeline["status"] == "failed"]
+    if failed:
+        sys.exit(1)
+
+
+@click.command()
+@click.option(
+    "-a",
+    "--assigned",
+    is_flag=True,
+    help="Lists the merge requests assigned to you instead.",
+)
+@click.pass_obj
+def reviews(lancet, assigned):
+    """List the open pull requests of all projects awaiting your review."""
+    with taskstatus("Looking up pull requests") as ts:
+        try:
+            merge_requests = lancet.scm_manager.get_review_requests(assigned)
+        except GitlabError as e:
+            ts.abort("Could not list the pull requests: {}", e)
+        ts.ok("Found {} open pull requests", len(merge_requests))
+
+    if not merge_requests:
+        return
+
+    # Map the projects to the workspace using the project index (and the
+    # project paths for the projects which are not indexed yet).
+    project_cache = getattr(lancet.scm_manager, "project_cache", None)
+    names_by_id, names_by_path = {}, {}
+    for name, remote_url in get_project_remotes(lancet):
+        names_by_path[get_project_path(remote_url)] = name
+        if project_cache is not None and remote_url in project_cache.data:
+            names_by_id[project_cache.data[remote_url]] = name
+
+    table = []
+    for mr in merge_requests:
+        path = urlparse(mr["web_url"]).path.split("/-/", 1)[0].strip("/")
+        name = names_by_id.get(mr["project_id"]) or names_by_path.get(path)
+        title = mr["title"]
+        if len(title) > 50:
+            title = title[:50] + "..."
+        table.append(
+            [
+                click.style(name, fg="green") if name else path,
+                "!{}".format(mr["iid"]),
+                title,
+                mr["author"]["username"],
+                mr["updated_at"][:10],
+                mr["web_url"],
+            ]
+        )
+
+    click.echo()
+    headers = ["Project", "MR", "Title", "Author", "Updated", "Link"]
+    click.echo(tabulate(table, headers, tablefmt="simple"))
+
+
+@click.command()
+@click.option("--base", "-b", "base_branch", help="Branch to merge into.")
+@click.option(
+    "--no-ff",
+    is_flag=True,
+    help="Creates a merge commit even if a fast-forward is possible.",
+)
+@click.argument("issue", required=False)
+@click.pass_context
+def merge(ctx, base_branch, no_ff, issue):
+    """
+    Merge the working branch of an issue into the base branch, push the
+    result, delete the working branch and transition the issue.
+    """
+    lancet = ctx.obj
+    repo = lancet.repo
+
+    merged_status = lancet.config.get("tracker", "merged_status")
+    remote_name = lancet.config.get("repository", "remote_name")
+
+    if not base_branch:
+        base_branch = lancet.config.get("repository", "base_branch")
+
+    issue = get_issue(lancet, issue)
+
+    transition = get_transition(ctx, lancet, issue, merged_status)
+
+    branch = get_branch(lancet, issue, create=False)
+    if not branch:
+        click.secho("No working branch found", fg="red", bold=True)
+        ctx.exit(1)
+
+    # Only the two branches involved in the merge are fetched
+    with taskstatus('Fetching from "{}"', remote_name) as ts:
+        base, remote_branch = fetch_branches(
+            lancet, ts, base_branch, branch.branch_name
+        )
+        if base is None:
+            ts.abort('Branch "{}" not found on the remote', base_branch)
+        if (
+            remote_branch is not None
+            and remote_branch.target != branch.target
+            and not repo.descendant_of(branch.target, remote_branch.target)
+        ):
+            ts.abort(
+                'The remote "{}" branch has changes missing locally',
+                branch.branch_name,
+            )
+        ts.ok('Fetched latest changes from "{}"', remote_name)
+
+    with taskstatus(
+        'Merging "{}" into "{}"', branch.branch_name, base_branch
+    ) as ts:
+        result = merge_in_memory(
+            repo,
+            base.target,
+            branch.target,
+            MergeBaseCache(lancet.get_repo_cache_path("merge-bases.json")),
+        )
+        if result.conflicts:
+            abort_on_conflicts(ts, base_branch, result.conflicts)
+        if not result.behind:
+            ts.abort('"{}" is already merged', branch.branch_name)
+
+        if result.is_fast_forward and not no_ff:
+            target = branch.target
+            ts.ok("Fast-forwarded {} commits", result.behind)
+        else:
+            message = "Merge branch '{}' into '{}'\n\n{} {}\n".format(
+                branch.branch_name, base_branch, issue.id, issue.summary
+            )
+            signature = repo.default_signature
+            target = repo.create_commit(
+                None,
+                signature,
+                signature,
+                message,
+                result.write_tree(repo),
+                [base.target, branch.target],
+            )
+            ts.ok("Created merge commit {}", str(target)[:10])
+
+    local_base = repo.lookup_branch(base_branch)
+    if local_base is not None:
+        if local_base.target != target and not repo.descendant_of(
+            target, local_base.target
+        ):
+            click.secho(
+                'The local "{}" branch has unpushed changes'.format(
+                    base_branch
+                ),
+                fg="red",
+                bold=True,
+            )
+            ctx.exit(1)
+        if local_base.is_checked_out() and not local_base.is_head():
+            click.secho(
+                '"{}" is checked out in another worktree'.format(base_branch),
+                fg="red",
+                bold=True,
+            )
+            ctx.exit(1)
+
+    # The base branch update and the working branch deletion are pushed at
+    # once, before touching any local reference.
+    with taskstatus('Pushing to "{}"', remote_name) as ts:
+        remote = repo.lookup_remote(remote_name)
+        base_refspec = "{}:refs/heads/{}".format(target, base_branch)
+        callbacks = lancet.get_remote_callbacks()
+        try:
+            push(repo, remote, [base_refspec, ":" + branch.name], callbacks)
+        except PushRejected as e:
+            if "refs/heads/" + base_branch not in e.rejected:
+                # Only the deletion of the working branch was refused
+                ts.fail("{}", e.message)
+            else:
+                if remote_branch is not None and e.pushed:
+                    # Restore the working branch deleted by the same push
+                    push(
+                        repo,
+                        remote,
+                        ["{}:{}".format(remote_branch.target, branch.name)],
+                        callbacks,
+                    )
+                ts.abort("{}", e.message)
+        else:
+            ts.ok('Pushed "{}" to "{}"', base_branch, remote_name)
+
+    # The base branch is updated without checking it out, unless it is the
+    # current branch.
+    with taskstatus('Updating "{}"', base_branch) as ts:
+        if local_base is None:
+            local_base = repo.create_branch(base_branch, repo[target])
+        else:
+            if local_base.is_head():
+                repo.checkout_tree(
+                    repo[target], strategy=pygit2.GIT_CHECKOUT_SAFE
+                )
+            local_base.set_target(
+                target, "merge {}".format(branch.branch_name)
+            )
+        ts.ok('Updated "{}"', base_branch)
+
+    with taskstatus("Deleting working branch") as ts:
+        branch_name = branch.branch_name
+        if branch.is_head():
+            repo.checkout(local_base.name)
+        try:
+            branch.delete()
+        except pygit2.GitError as e:
+            ts.fail('Could not delete "{}": {}', branch_name, e)
+        else:
+            ts.ok('Deleted "{}"', branch_name)
+
+    set_issue_status(lancet, issue, merged_status, transition)
@@ -13,6 +13,7 @@ from ..helpers import (
     get_project_keys,
     get_project_dirs,
     create_issue,
+    checkout_branch,
 )
 
 
@@ -102,7 +103,8 @@ def workon(ctx, issue_id, new, base_branch):
 
     if new:
         # Create a new issue
-        summary = click.prompt("Issue summary")
+        with lancet.deadline.paused():
+            summary = click.prompt("Issue summary")
         issue = create_issue(
             lancet, summary=summary, add_to_active_sprint=True
         )
@@ -127,8 +129,11 @@ def workon(ctx, issue_id, new, base_branch):
     set_issue_status(lancet, issue, active_status, transition)
 
     with taskstatus("Checking out working branch") as ts:
-        lancet.repo.checkout(branch.name)
-        ts.ok('Checked out working branch based on "{}"'.format(base_branch))
+        path = checkout_branch(lancet, branch)
+        if path:
+            ts.ok('Switched to the worktree at "{}"', path)
+        else:
+            ts.ok('Checked out working branch based on "{}"', base_branch)
 
     with taskstatus("Starting harvest timer") as ts:
         lancet.timer.start(issue)
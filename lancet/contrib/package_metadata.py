@@ -0,0 +1,221 @@
+"""
+Resolution of the name and version of a Python package, reading its
+metadata files instead of executing its setup script whenever possible.
+"""
+
+import os
+import re
+import ast
+import json
+import subprocess
+import configparser
+from email.parser import HeaderParser
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+
+# Executed in a subprocess, as the python version of the package may differ
+# from the one which executes lancet.
+SETUP_SCRIPT = """
+import json, setuptools
+from distutils.core import run_setup
+dist = run_setup("setup.py", stop_after="init")
+print(json.dumps({"name": dist.get_name(), "version": dist.get_version()}))
+"""
+
+VERSION_MODULES = ("__init__.py", "version.py", "_version.py", "__about__.py")
+
+
+def read_file(path):
+    try:
+        with open(path, encoding="utf-8") as fh:
+            return fh.read()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def find_assignment(content, name):
+    match = re.search(
+        r"""^{}\s*=\s*u?['"]([^'"]+)['"]""".format(re.escape(name)),
+        content,
+        re.MULTILINE,
+    )
+    return match.group(1) if match else None
+
+
+def read_version_attr(directory, reference):
+    """Read a ``package.module.__version__`` style reference statically."""
+    module, _, name = reference.strip().rpartition(".")
+    base = module.replace(".", os.sep)
+    for root in ("", "src"):
+        for candidate in (base + ".py", os.path.join(base, "__init__.py")):
+            content = read_file(os.path.join(directory, root, candidate))
+            if content is not None:
+                return find_assignment(content, name)
+    return None
+
+
+def read_version_file(directory, path):
+    content = read_file(os.path.join(directory, path.strip()))
+    return content.strip() if content else None
+
+
+def read_package_version(directory, name):
+    """Look for ``__version__`` in the conventional modules of a package."""
+    package = name.replace("-", "_")
+    for root in ("", "src"):
+        for module in VERSION_MODULES:
+            content = read_file(os.path.join(directory, root, package, module))
+            version = content and find_assignment(content, "__version__")
+            if version:
+                return version
+    return None
+
+
+def read_pyproject(directory):
+    content = read_file(os.path.join(directory, "pyproject.toml"))
+    if content is None or tomllib is None:
+        return {}
+    data = tomllib.loads(content)
+    tool = data.get("tool", {})
+
+    project = data.get("project", {})
+    poetry = tool.get("poetry", {})
+    metadata = {
+        "name": project.get("name") or poetry.get("name"),
+        "version": project.get("version") or poetry.get("version"),
+    }
+
+    dynamic = tool.get("setuptools", {}).get("dynamic", {}).get("version")
+    if dynamic and "attr" in dynamic:
+        metadata["version_attr"] = dynamic["attr"]
+    elif dynamic and "file" in dynamic:
+        files = dynamic["file"]
+        metadata["version_file"] = (
+            files if isinstance(files, str) else files[0]
+        )
+    return metadata
+
+
+def read_setup_cfg(directory):
+    parser = configparser.ConfigParser(interpolation=None)
+    if not parser.read(os.path.join(directory, "setup.cfg")):
+        return {}
+    if not parser.has_section("metadata"):
+        return {}
+
+    metadata = {"name": parser.get("metadata", "name", fallback=None)}
+    version = parser.get("metadata", "version", fallback=None)
+    if version and version.startswith("attr:"):
+        metadata["version_attr"] = version[len("attr:") :]
+    elif version and version.startswith("file:"):
+        metadata["version_file"] = version[len("file:") :]
+    else:
+        metadata["version"] = version
+    return metadata
+
+
+def read_setup_py(directory):
+    """
+    Extract the arguments of the ``setup()`` call which are string literals
+    (or names bound to string literals at the module level).
+    """
+    content = read_file(os.path.join(directory, "setup.py"))
+    if content is None:
+        return {}
+    try:
+        tree = ast.parse(content)
+    except SyntaxError:
+        return {}
+
+    constants = {}
+    for node in tree.body:
+        if (
+            isinstance(node, ast.Assign)
+            and isinstance(node.value, ast.Constant)
+            and isinstance(node.value.value, str)
+        ):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+
+    metadata = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        func_name = func.attr if isinstance(func, ast.Attribute) else None
+        if isinstance(func, ast.Name):
+            func_name = func.id
+        if func_name != "setup":
+            continue
+        for keyword in node.keywords:
+            if keyword.arg not in ("name", "version"):
+                continue
+            value = keyword.value
+            if isinstance(value, ast.Constant) and isinstance(
+                value.value, str
+            ):
+                metadata[keyword.arg] = value.value
+            elif isinstance(value, ast.Name) and value.id in constants:
+                metadata[keyword.arg] = constants[value.id]
+    return metadata
+
+
+def read_pkg_info(directory):
+    # Only the PKG-INFO file of an unpacked sdist is considered, the ones
+    # in *.egg-info directories are stale as soon as the version changes.
+    content = read_file(os.path.join(directory, "PKG-INFO"))
+    if content is None:
+        return {}
+    headers = HeaderParser().parsestr(content)
+    return {"name": headers.get("Name"), "version": headers.get("Version")}
+
+
+def get_static_metadata(directory="."):
+    """
+    Return the ``(name, version)`` of the package in the given directory,
+    as found in its metadata files. Values which can only be known by
+    executing code are returned as ``None``.
+    """
+    metadata = {}
+    for reader in (
+        read_pyproject,
+        read_setup_cfg,
+        read_setup_py,
+        read_pkg_info,
+    ):
+        for key, value in reader(directory).items():
+            if value and not metadata.get(key):
+                metadata[key] = value
+
+    name = metadata.get("name")
+    version = metadata.get("version")
+    if not version and metadata.get("version_attr"):
+        version = read_version_attr(directory, metadata["version_attr"])
+    if not version and metadata.get("version_file"):
+        version = read_version_file(directory, metadata["version_file"])
+    if not version and name:
+        version = read_package_version(directory, name)
+    if not version:
+        version = read_version_file(directory, "VERSION")
+    return name, version
+
+
+def get_setup_metadata(directory="."):
+    """
+    Return the ``(name, version)`` of the package in the given directory by
+    executing its setup script, in a single subprocess.
+    """
+    output = subprocess.check_output(
+        ["python", "-c", SETUP_SCRIPT], cwd=directory
+    )
+    # The setup script itself may print to stdout
+    data = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    return data["name"], data["version"]
@@ -1,11 +1,11 @@
-from collections import OrderedDict
-import subprocess
-
 import click
 import pygit2
 from jinja2 import Template
 
-from ..utils import content_from_path
+from ..git import push, PushRejected
+from ..history import ContributorIndex
+from .package_metadata import get_static_metadata, get_setup_metadata
+from ..utils import content_from_path, taskstatus
 
 
 @click.command()
@@ -15,31 +15,36 @@ def contributors(lancet, output):
     """
     List all contributors visible in the git history.
     """
-    sorting = pygit2.GIT_SORT_TIME | pygit2.GIT_SORT_REVERSE
-    commits = lancet.repo.walk(lancet.repo.head.target, sorting)
-    contributors = ((c.author.name, c.author.email) for c in commits)
-    contributors = OrderedDict(contributors)
+    # Only the commits added since the previous run are walked
+    index = ContributorIndex(lancet.get_repo_cache_path("contributors.json"))
+    index.update(lancet.repo, [lancet.repo.head.target])
+    contributors = index.get_contributors(lancet.repo)
 
     template_content = content_from_path(
         lancet.config.get("packaging", "contributors_template")
     )
     template = Template(template_content)
-    output.write(template.render(contributors=contributors).encode("utf-8"))
+    for chunk in template.generate(contributors=contributors):
+        output.write(chunk.encode("utf-8"))
 
 
 @click.command()
+@click.option(
+    "-p",
+    "--push/--no-push",
+    "push_tag",
+    default=False,
+    help="Push the current branch and the new tag to the remote.",
+)
 @click.argument("version", required=False)
 @click.pass_obj
-def tag_version(lancet, version):
-    # NOTE: We're using a subprocess instead of interpreting the setup.py file
-    # as the python version of the package may differ from the one which
-    # executes lancet.
-    if not version:
-        version = subprocess.check_output(["python", "setup.py", "--version"])
-        version = version.strip().decode("ascii")
-
-    name = subprocess.check_output(["python", "setup.py", "--name"])
-    name = name.strip().decode("ascii")
+def tag_version(lancet, version, push_tag):
+    # The setup script is only executed if the metadata files are not enough
+    name, static_version = get_static_metadata()
+    version = version or static_version
+    if not name or not version:
+        name, setup_version = get_setup_metadata()
+        version = version or setup_version
 
     tag_name = lancet.config.get("packaging", "version_tag_name").format(
         name=name, version=version
@@ -54,7 +59,10 @@ def tag_version(lancet, version):
         )
     )
 
-    if click.confirm("Do you want to continue?"):
+    with lancet.deadline.paused():
+        confirmed = click.confirm("Do you want to continue?")
+
+    if confirmed:
         lancet.repo.create_tag(
             tag_name,
             lancet.repo.head.target,
@@ -62,3 +70,18 @@ def tag_version(lancet, version):
             lancet.repo.default_signature,
             tag_message,
         )
+
+        if push_tag:
+            remote_name = lancet.config.get("repository", "remote_name")
+            with taskstatus('Pushing to "{}"', remote_name) as ts:
+                remote = lancet.repo.lookup_remote(remote_name)
+                try:
+                    push(
+                        lancet.repo,
+                        remote,
+                        [lancet.repo.head.name, "refs/tags/" + tag_name],
+                        lancet.get_remote_callbacks(),
+                    )
+                except PushRejected as e:
+                    ts.abort("{}", e.message)
+                ts.ok('Pushed {} to "{}"', tag_name, remote_name)
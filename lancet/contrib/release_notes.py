@@ -1,7 +1,12 @@
+
+import attr
 import click
+import pygit2
 
 from tabulate import tabulate
 
+from lancet.helpers import get_issue_key_pattern
+from lancet.history import get_range_issue_keys
 from lancet.utils import taskstatus, edit_template
 
 
@@ -26,6 +31,92 @@ def get_issues_fixed_in_version(lancet, project_key, version_name):
     )
 
 
+@attr.s
+class GitVersion:
+    """Version known only by its name, for releases computed from git."""
+
+    name = attr.ib()
+
+
+def resolve_commit(lancet, revision):
+    remote_name = lancet.config.get("repository", "remote_name")
+    for rev in (revision, f"{remote_name}/{revision}"):
+        try:
+            return lancet.repo.revparse_single(rev).peel(pygit2.Commit)
+        except (KeyError, ValueError, pygit2.GitError):
+            continue
+    return None
+
+
+def get_previous_tag(repo, commit):
+    """
+    Return the name of the most recent tag reachable from a commit, not
+    considering the tags of the commit itself (the version being released
+    may already be tagged).
+    """
+    while True:
+        try:
+            tag_name = repo.describe(
+                committish=str(commit.id),
+                describe_strategy=pygit2.GIT_DESCRIBE_TAGS,
+                abbreviated_size=0,
+            )
+        except (KeyError, pygit2.GitError):
+            return None
+        tagged = repo.revparse_single("refs/tags/" + tag_name)
+        if tagged.peel(pygit2.Commit).id != commit.id:
+            return tag_name
+        if not commit.parents:
+            return None
+        commit = commit.parents[0]
+
+
+def get_issues_from_git(lancet, project_key, target, since):
+    with taskstatus("Collecting issue keys from the git history") as ts:
+        target_commit = resolve_commit(lancet, target)
+        if target_commit is None:
+            ts.abort('Revision "{}" not found', target)
+
+        if since is None:
+            since = get_previous_tag(lancet.repo, target_commit)
+        if since is None:
+            since_id = None
+        else:
+            since_commit = resolve_commit(lancet, since)
+            if since_commit is None:
+                ts.abort('Revision "{}" not found', since)
+            since_id = since_commit.id
+
+        name_getter = lancet.get_instance_from_config(
+            "repository", "branch_name_getter", lancet
+        )
+        issue_keys, count = get_range_issue_keys(
+            lancet.repo,
+            target_commit.id,
+            since_id,
+            get_issue_key_pattern(lancet),
+            name_getter,
+        )
+        # Keys of other projects are mentioned for reference only, and bare
+        # numbers (e.g. pull request numbers) are not keys of this tracker.
+        issue_keys = sorted(
+            k for k in issue_keys if k.startswith(project_key + "-")
+        )
+        ts.ok(
+            "Found {} issues in {} commits since {}",
+            len(issue_keys),
+            count,
+            since or "the first commit",
+        )
+
+    with taskstatus("Retrieving issues from the issue tracker") as ts:
+        issues = lancet.tracker.get_issues(project_key, issue_keys)
+        ts.ok("Retrieved {} issues", len(issues))
+
+    # The release notes template works with the issues of the tracker API
+    return [issue.issue for issue in issues]
+
+
 @click.command()
 @click.pass_obj
 def list_versions(lancet):
@@ -76,40 +167,71 @@ def list_versions(lancet):
     default=False,
     help="Opens the link with the release.",
 )
+@click.option(
+    "-g",
+    "--from-git",
+    is_flag=True,
+    help=(
+        "Collects the issues mentioned in the commits since the previous "
+        "tag instead of searching the fix version on the tracker."
+    ),
+)
+@click.option(
+    "--since",
+    help="Revision to collect the commits from (defaults to the last tag).",
+)
 @click.argument("version_name", metavar="version")
 @click.pass_obj
-def release_notes(lancet, version_name, target, draft, prerelease, open_link):
+def release_notes(
+    lancet,
+    version_name,
+    target,
+    draft,
+    prerelease,
+    open_link,
+    from_git,
+    since,
+):
     project_key = lancet.config.get("tracker", "default_project")
 
-    with taskstatus("Getting version") as ts:
-        version = get_version(lancet, project_key, version_name)
-        if not version:
-            ts.abort(
-                "Version {} not found for project {}",
-                version_name,
-                project_key,
-            )
+    if target is None:
+        target = lancet.config.get("repository", "base_branch")
 
-        ts.ok("Got version {}", version.name)
+    if from_git:
+        version = GitVersion(version_name)
+        issues = get_issues_from_git(lancet, project_key, target, since)
+    else:
+        with taskstatus("Getting version") as ts:
+            version = get_version(lancet, project_key, version_name)
+            if not version:
+                ts.abort(
+                    "Version {} not found for project {}",
+                    version_name,
+                    project_key,
+                )
 
-    with taskstatus("Getting issues fixed in version {}", version.name) as ts:
-        issues = get_issues_fixed_in_version(lancet, project_key, version_name)
-        ts.ok("Found {} issues", len(issues))
+            ts.ok("Got version {}", version.name)
+
+        with taskstatus(
+            "Getting issues fixed in version {}", version.name
+        ) as ts:
+            issues = get_issues_fixed_in_version(
+                lancet, project_key, version_name
+            )
+            ts.ok("Found {} issues", len(issues))
 
     with taskstatus("Creating release") as ts:
-        notes = edit_template(
-            lancet.config.get("tracker", "release_notes_template"),
-            issues=issues,
-            version=version,
-        )
+        with lancet.deadline.paused():
+            notes = edit_template(
+                lancet.config.get("tracker", "release_notes_template"),
+                issues=issues,
+                version=version,
+            )
         if not notes:
             ts.abort("No release notes provided")
 
         name, notes = notes.split("\n\n", 1)
 
-        if target is None:
-            target = lancet.config.get("repository", "base_branch")
-
         release = lancet.github_repo.create_release(
             version_name,
             target_commitish=target,
@@ -0,0 +1,83 @@
+"""
+Latency budget shared by all the network operations of a command.
+"""
+
+import time
+import contextlib
+
+import click
+
+
+class DeadlineExceeded(click.ClickException):
+    def __init__(self, budget):
+        super().__init__(
+            "The command did not complete within its time budget of {:g} "
+            "seconds. Check your network connection and try again (the "
+            "budget can be changed with the command_timeout setting in the "
+            "[lancet] section).".format(budget)
+        )
+
+
+class Deadline:
+    """
+    Point in time by which all the network operations have to complete.
+
+    A budget of ``None`` or ``0`` disables the deadline.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.restart()
+
+    def restart(self):
+        """
+        Grant the whole budget again, for commands doing several rounds of
+        network operations (e.g. polling).
+        """
+        budget = self.budget
+        self.expires_at = time.monotonic() + budget if budget else None
+
+    @contextlib.contextmanager
+    def paused(self):
+        """
+        Stop the clock while waiting for the user (prompts, editor), so that
+        only the time spent on network operations is charged to the budget.
+        """
+        paused_at = time.monotonic()
+        try:
+            yield
+        finally:
+            if self.expires_at is not None:
+                self.expires_at += time.monotonic() - paused_at
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+
+    def check(self):
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(self.budget)
+
+    @property
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def cap(self, timeout):
+        """
+        Limit a timeout (a number or a ``(connect, read)`` tuple) to the
+        remaining budget.
+        """
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        if isinstance(timeout, tuple):
+            return tuple(
+                remaining if t is None else min(t, remaining) for t in timeout
+            )
+        return min(timeout, remaining)
@@ -1,13 +1,16 @@
+import os
 import sys
 import re
-import six
+import bisect
+import inspect
 
+import attr
 import pygit2
 import click
 from slugify import slugify
 from giturlparse import parse as giturlparse
 
-from .utils import taskstatus
+from .utils import taskstatus, format_size, JSONFile
 
 
 TOKEN_USER = b"x-oauth-basic"
@@ -15,12 +18,60 @@ TOKEN_USER = b"x-oauth-basic"
 
 class PrefixedIDBranchName:
     slug_length = 50
+    issue_key_pattern = r"(?:[A-Z]{2,}-)?[0-9]+"
 
     def get_prefix(self, issue):
         raise NotImplementedError()
 
+    def get_prefixes(self):
+        raise NotImplementedError()
+
+    def get_discriminators(self, issue_key):
+        """
+        Return every discriminator a branch of the given issue can have,
+        without having to retrieve the issue from the tracker.
+        """
+        return sorted(
+            {"{}{}_".format(p, issue_key) for p in self.get_prefixes()}
+        )
+
+    def compile_key_patterns(self):
+        """
+        Compile the patterns matching the issue key at the start of a branch
+        name: one for all the non-empty prefixes, and one for the empty
+        prefix (if any), which is only tried as a fallback.
+        """
+        prefixes = [p for p in self.get_prefixes() if p]
+        suffix = "(" + self.issue_key_pattern + ")(?:_|$)"
+        self._prefixed_key_pattern = None
+        self._unprefixed_key_pattern = None
+        if prefixes:
+            self._prefixed_key_pattern = re.compile(
+                "^(?:{})".format("|".join(re.escape(p) for p in prefixes))
+                + suffix
+            )
+        if len(prefixes) < len(self.get_prefixes()):
+            self._unprefixed_key_pattern = re.compile("^" + suffix)
+
+    def match_issue_key(self, branch_name, strict=False):
+        """
+        Return the issue key of a branch name, or None if it has none. With
+        ``strict``, names only matching through an empty prefix are ignored.
+        """
+        patterns = [self._prefixed_key_pattern]
+        if not strict:
+            patterns.append(self._unprefixed_key_pattern)
+        for pattern in patterns:
+            match = pattern and pattern.match(branch_name)
+            if match:
+                return match.group(1)
+        return None
+
     def get_issue_key(self, branch_name):
-        raise Exception("Unable to find current issue.")
+        issue_key = self.match_issue_key(branch_name)
+        if issue_key is None:
+            raise Exception("Unable to find current issue.")
+        return issue_key
 
     def __call__(self, issue):
         discriminator = "{}{}_".format(self.get_prefix(issue), issue.id)
@@ -30,21 +81,51 @@ class PrefixedIDBranchName:
 
 
 class FixedPrefixIDBranchName(PrefixedIDBranchName):
+    issue_key_pattern = r"[A-Z]{2,}-[0-9]+"
+
     def __init__(self, prefix):
         self._prefix = prefix
+        self.compile_key_patterns()
 
     def get_prefix(self, issue):
         return self._prefix
 
-    def get_issue_key(self, branch_name):
-        match = re.search(self._prefix + r"([A-Z]{2,}-[0-9]+)", branch_name)
-        if match is None:
-            raise Exception("Unable to find current issue.")
-        return match.group(1)
+    def get_prefixes(self):
+        return [self._prefix]
 
 
 class CredentialsCallbacks(pygit2.RemoteCallbacks):
+    def __init__(self, deadline=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deadline = deadline
+        self.on_progress = None
+        # Reasons of the remote for refusing references, by reference name
+        self.rejected_refs = {}
+
+    def check_deadline(self):
+        # Exceptions raised in callbacks abort the running git operation
+        if self.deadline is not None:
+            self.deadline.check()
+
+    def transfer_progress(self, stats):
+        self.check_deadline()
+        if self.on_progress is not None:
+            self.on_progress(stats)
+
+    def sideband_progress(self, string):
+        self.check_deadline()
+
+    def push_transfer_progress(self, objects_pushed, total_objects, bytes):
+        self.check_deadline()
+
+    def push_update_reference(self, refname, message):
+        # Called for each pushed reference; libgit2 does not fail the push
+        # when only some of them are refused (e.g. protected branches).
+        if message:
+            self.rejected_refs[refname] = message
+
     def credentials(self, url, username_from_url, allowed_types):
+        self.check_deadline()
         if allowed_types & pygit2.credentials.GIT_CREDTYPE_USERNAME:
             raise NotImplementedError
         elif allowed_types & pygit2.credentials.GIT_CREDTYPE_SSH_KEY:
@@ -56,6 +137,7 @@ class CredentialsCallbacks(pygit2.RemoteCallbacks):
 class TaskTypePrefixIDBranchName(PrefixedIDBranchName):
     def __init__(self, prefixes):
         self._prefixes = prefixes
+        self.compile_key_patterns()
 
     def get_prefix(self, issue):
         try:
@@ -74,13 +156,8 @@ class TaskTypePrefixIDBranchName(PrefixedIDBranchName):
             )
         )
 
-    def get_issue_key(self, branch_name):
-        for prefix in six.itervalues(self._prefixes):
-            match = re.search(prefix + r"((?:[A-Z]{2,}-)?[0-9]+)", branch_name)
-            if match is not None:
-                return match.group(1)
-        else:
-            raise Exception("Unable to find current issue.")
+    def get_prefixes(self):
+        return list(self._prefixes.values())
 
     @classmethod
     def fromstring(cls, string):
@@ -96,11 +173,321 @@ def prefixed_id_branch_name(lancet):
     return TaskTypePrefixIDBranchName.fromstring(prefix)
 
 
+def get_branch_name(ref_name):
+    """
+    Return the name of a branch from the name of a local or remote-tracking
+    reference (e.g. ``refs/remotes/origin/<name>``).
+    """
+    if ref_name.startswith("refs/heads/"):
+        return ref_name[len("refs/heads/") :]
+    if ref_name.startswith("refs/remotes/"):
+        return ref_name[len("refs/remotes/") :].split("/", 1)[-1]
+    return ref_name
+
+
+def get_common_dir(repo):
+    """Return the directory holding the references shared by all worktrees."""
+    try:
+        with open(os.path.join(repo.path, "commondir")) as fh:
+            return os.path.normpath(os.path.join(repo.path, fh.read().strip()))
+    except FileNotFoundError:
+        return repo.path
+
+
+class PackedRefs:
+    """Sorted snapshot of the reference names in a packed-refs file."""
+
+    _snapshots = {}
+
+    def __init__(self, names):
+        self.names = names
+
+    @classmethod
+    def load(cls, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return cls([])
+
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if key not in cls._snapshots:
+            with open(path, "rb") as fh:
+                lines = fh.read().decode("utf-8").splitlines()
+            names = [
+                line.split(" ", 1)[1]
+                for line in lines
+                if line and line[0] not in "#^"
+            ]
+            if not lines or "sorted" not in lines[0]:
+                names.sort()
+            cls._snapshots = {key: cls(names)}
+        return cls._snapshots[key]
+
+    def iter_prefix(self, prefix):
+        for name in self.names[bisect.bisect_left(self.names, prefix) :]:
+            if not name.startswith(prefix):
+                break
+            yield name
+
+
+def iter_loose_refs(refs_dir, prefix):
+    directory, partial = prefix.rsplit("/", 1)
+    try:
+        entries = list(os.scandir(os.path.join(refs_dir, directory)))
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for entry in entries:
+        if not entry.name.startswith(partial) or entry.name.endswith(".lock"):
+            continue
+        name = "{}/{}".format(directory, entry.name)
+        if entry.is_dir():
+            yield from iter_loose_refs(refs_dir, name + "/")
+        else:
+            yield name
+
+
+def iter_references(repo, prefix):
+    """
+    Yield the names of the references starting with ``prefix``, without
+    listing all the references of the repository.
+
+    Only the loose references in the directory of the prefix are looked at;
+    packed references are found with a binary search in a sorted snapshot of
+    the packed-refs file, reused as long as the file does not change.
+    """
+    common_dir = get_common_dir(repo)
+    if os.path.exists(os.path.join(common_dir, "reftable")):
+        # Not a files-based reference store
+        for name in repo.listall_references():
+            if name.startswith(prefix):
+                yield name
+        return
+
+    packed = PackedRefs.load(os.path.join(common_dir, "packed-refs"))
+    names = set(iter_loose_refs(common_dir, prefix))
+    names.update(packed.iter_prefix(prefix))
+    yield from sorted(names)
+
+
+def fetch(remote, refspecs, callbacks, ts, depth=0):
+    """
+    Fetch the given refspecs only, reporting the progress on ``ts``.
+
+    A non-zero ``depth`` requests a shallow fetch, which is only supported
+    by recent versions of pygit2 and ignored otherwise.
+    """
+    kwargs = {}
+    if depth:
+        if "depth" in inspect.signature(remote.fetch).parameters:
+            kwargs["depth"] = depth
+        else:
+            click.secho(
+                "Shallow fetches are not supported by the installed pygit2 "
+                "version, fetching the full history.",
+                fg="yellow",
+            )
+
+    progress = {"percent": None}
+
+    def report(stats):
+        if not stats.total_objects:
+            return
+        percent = 100 * stats.received_objects // stats.total_objects
+        if percent != progress["percent"]:
+            progress["percent"] = percent
+            ts.update(
+                'Fetching from "{}" ({}%, {})',
+                remote.name,
+                percent,
+                format_size(stats.received_bytes),
+            )
+
+    callbacks.on_progress = report
+    try:
+        return remote.fetch(refspecs=refspecs, callbacks=callbacks, **kwargs)
+    finally:
+        callbacks.on_progress = None
+
+
+class PushRejected(click.ClickException):
+    def __init__(self, rejected, pushed):
+        self.rejected = rejected
+        self.pushed = pushed
+        super().__init__(
+            "The remote rejected {}".format(
+                ", ".join(
+                    '"{}" ({})'.format(refname, message)
+                    for refname, message in sorted(rejected.items())
+                )
+            )
+        )
+
+
+def get_destination(refspec):
+    src, _, dst = refspec.lstrip("+").partition(":")
+    return dst or src
+
+
+def is_pushed(repo, remote_name, refspec):
+    """
+    Tell whether the remote-tracking branch already matches the result of
+    pushing the given refspec.
+
+    Only branches have remote-tracking references; other refspecs are never
+    considered as pushed.
+    """
+    src = refspec.lstrip("+").partition(":")[0]
+    dst = get_destination(refspec)
+    if not dst.startswith("refs/heads/"):
+        return False
+
+    tracking_name = "refs/remotes/{}/{}".format(
+        remote_name, dst[len("refs/heads/") :]
+    )
+    try:
+        remote_target = repo.lookup_reference(tracking_name).target
+    except KeyError:
+        remote_target = None
+
+    if not src:
+        # Deletion
+        return remote_target is None
+    try:
+        local_target = repo.lookup_reference(src).resolve().target
+    except (KeyError, ValueError):
+        return False
+    return local_target == remote_target
+
+
+def push(repo, remote, refspecs, callbacks):
+    """
+    Push all the given refspecs at once, over a single connection.
+
+    Refspecs which would not change anything on the remote are skipped, and
+    no connection is opened at all if none is left. Returns the pushed
+    refspecs, or raises PushRejected if the remote refused some of them
+    (the others are applied nevertheless).
+    """
+    refspecs = [r for r in refspecs if not is_pushed(repo, remote.name, r)]
+    if refspecs:
+        callbacks.rejected_refs.clear()
+        remote.push(refspecs, callbacks=callbacks)
+        rejected = dict(callbacks.rejected_refs)
+        if rejected:
+            raise PushRejected(
+                rejected,
+                [r for r in refspecs if get_destination(r) not in rejected],
+            )
+    return refspecs
+
+
+class MergeBaseCache(JSONFile):
+    """
+    Merge base and ahead/behind counts of pairs of commits. Commits never
+    change, so entries never become stale; only the most recent are kept.
+    """
+
+    max_entries = 200
+
+    def get(self, ours, theirs):
+        return self.data.get("{}:{}".format(ours, theirs))
+
+    def set(self, ours, theirs, base, ahead, behind):
+        self.data["{}:{}".format(ours, theirs)] = [
+            str(base) if base else None,
+            ahead,
+            behind,
+        ]
+        for key in list(self.data)[: -self.max_entries]:
+            del self.data[key]
+        self.save()
+
+
+@attr.s
+class MergeResult:
+    ahead = attr.ib()
+    behind = attr.ib()
+    conflicts = attr.ib(default=attr.Factory(list))
+    # Tree of the merge, when known without merging the trees
+    tree = attr.ib(default=None)
+    # In-memory index with the result of merging the trees
+    index = attr.ib(default=None)
+
+    @property
+    def is_fast_forward(self):
+        return not self.ahead
+
+    def write_tree(self, repo):
+        if self.tree is not None:
+            return self.tree
+        return self.index.write_tree(repo)
+
+
+def merge_in_memory(repo, ours, theirs, cache=None):
+    """
+    Merge the commit ``theirs`` into ``ours`` without touching the working
+    tree or the index of the repository.
+
+    The merge base and the ahead/behind counts are cached, and the trees
+    are only merged if both sides changed something since the merge base.
+    """
+    entry = cache.get(ours, theirs) if cache is not None else None
+    if entry is None:
+        base = repo.merge_base(ours, theirs)
+        ahead, behind = repo.ahead_behind(ours, theirs)
+        if cache is not None:
+            cache.set(ours, theirs, base, ahead, behind)
+    else:
+        base, ahead, behind = entry
+        base = pygit2.Oid(hex=base) if base else None
+
+    ours_tree = repo[ours].tree
+    theirs_tree = repo[theirs].tree
+    if not ahead:
+        # Fast-forward
+        return MergeResult(ahead, behind, tree=theirs_tree.id)
+    if not behind:
+        return MergeResult(ahead, behind, tree=ours_tree.id)
+
+    if base is None:
+        # Unrelated histories
+        base_tree = repo[repo.TreeBuilder().write()]
+    else:
+        base_tree = repo[base].tree
+    if theirs_tree.id in (base_tree.id, ours_tree.id):
+        return MergeResult(ahead, behind, tree=ours_tree.id)
+    if ours_tree.id == base_tree.id:
+        return MergeResult(ahead, behind, tree=theirs_tree.id)
+
+    # Unchanged subtrees are skipped by libgit2 while merging
+    index = repo.merge_trees(base_tree, ours_tree, theirs_tree)
+    conflicts = []
+    if index.conflicts is not None:
+        conflicts = sorted(
+            {
+                next(e for e in entries if e is not None).path
+                for entries in index.conflicts
+            }
+        )
+    return MergeResult(ahead, behind, conflicts, index=index)
+
+
 class BranchGetter:
-    def __init__(self, base_branch, branch_name_getter, remote_name="origin"):
+    def __init__(
+        self,
+        base_branch,
+        branch_name_getter,
+        remote_name="origin",
+        callbacks=None,
+        fetch_depth=0,
+    ):
         self.base_branch = base_branch
         self.remote_name = remote_name
         self.get_branch_name = branch_name_getter
+        if callbacks is None:
+            callbacks = CredentialsCallbacks()
+        self.callbacks = callbacks
+        self.fetch_depth = fetch_depth
 
     def get_base_branch(self, repo):
         return repo.lookup_branch(
@@ -114,13 +501,14 @@ class BranchGetter:
         if from_remote:
             branch_type = pygit2.GIT_BRANCH_REMOTE
             discriminator = "{}/{}".format(self.remote_name, discriminator)
+            refs_prefix = "refs/remotes/"
         else:
             branch_type = pygit2.GIT_BRANCH_LOCAL
+            refs_prefix = "refs/heads/"
 
         branches = [
-            b
-            for b in repo.listall_branches(branch_type)
-            if b.startswith(discriminator)
+            name[len(refs_prefix) :]
+            for name in iter_references(repo, refs_prefix + discriminator)
         ]
 
         if len(branches) > 1:
@@ -150,6 +538,21 @@ class BranchGetter:
                 branch = repo.lookup_branch(full_name)
             return branch
 
+    def get_fetch_refspecs(self, issue):
+        """
+        Return the refspecs needed to find the working branch of the given
+        issue or create it, instead of fetching the whole remote.
+        """
+        discriminator, _ = self.get_branch_name(issue)
+        return [
+            "+refs/heads/{0}:refs/remotes/{1}/{0}".format(
+                self.base_branch, self.remote_name
+            ),
+            "+refs/heads/{0}*:refs/remotes/{1}/{0}*".format(
+                discriminator, self.remote_name
+            ),
+        ]
+
     def __call__(self, repo, issue, create=True):
         branch = self.get_branch(repo, issue)
 
@@ -160,8 +563,19 @@ class BranchGetter:
                 if not remote:
                     ts.abort('Remote "{}" not found', self.remote_name)
 
-                remote.fetch(callbacks=CredentialsCallbacks())
-                ts.ok('Fetched latest changes from "{}"', self.remote_name)
+                stats = fetch(
+                    remote,
+                    self.get_fetch_refspecs(issue),
+                    self.callbacks,
+                    ts,
+                    depth=self.fetch_depth,
+                )
+                ts.ok(
+                    'Fetched latest changes from "{}" ({} objects, {})',
+                    self.remote_name,
+                    stats.received_objects,
+                    format_size(stats.received_bytes),
+                )
 
             # Check remote branches
             with taskstatus("Creating working branch") as ts:
@@ -1,11 +1,22 @@
 import os
+import re
+import sys
 import glob
 
 import click
+import pygit2
 
 from .settings import LOCAL_CONFIG, load_config
-from .git import BranchGetter
+from .git import (
+    BranchGetter,
+    MergeBaseCache,
+    iter_references,
+    fetch,
+    merge_in_memory,
+)
 from .utils import taskstatus
+from .history import IssueIndex
+from .tracker_queue import ASSIGN, TRANSITION
 
 
 def get_issue(lancet, issue_id=None):
@@ -15,7 +26,7 @@ def get_issue(lancet, issue_id=None):
             name_getter = lancet.get_instance_from_config(
                 "repository", "branch_name_getter", lancet
             )
-            issue_id = name_getter.get_issue_key(lancet.repo.head.name)
+            issue_id = name_getter.get_issue_key(lancet.repo.head.shorthand)
         issue = lancet.tracker.get_issue(project_id, issue_id)
         summary = issue.summary
         if len(summary) > 40:
@@ -25,6 +36,11 @@ def get_issue(lancet, issue_id=None):
 
 
 def get_transition(ctx, lancet, issue, to_status):
+    if lancet.tracker_queue is not None:
+        # Transitions are resolved (and conflicts reported) when the queued
+        # intent is replayed.
+        return None
+
     current_status = issue.status
     if current_status != to_status:
         transitions = issue.get_transitions(to_status)
@@ -55,7 +71,11 @@ def get_transition(ctx, lancet, issue, to_status):
 
 def set_issue_status(lancet, issue, to_status, transition):
     with taskstatus('Setting issue status to "{}"'.format(to_status)) as ts:
-        if transition is not None:
+        queue = lancet.tracker_queue
+        if queue is not None and issue.status != to_status:
+            queue.enqueue(TRANSITION, issue, to_status)
+            ts.ok('Issue status change to "{}" queued'.format(to_status))
+        elif transition is not None:
             issue.apply_transition(transition)
             ts.ok('Issue status set to "{}"'.format(to_status))
         else:
@@ -84,6 +104,9 @@ def assign_issue(lancet, issue, username, active_status):
                 ts.abort(
                     f"Issue already active and not assigned to {username}"
                 )
+            elif lancet.tracker_queue is not None:
+                lancet.tracker_queue.enqueue(ASSIGN, issue, username)
+                ts.ok(f"Issue assignment to {username} queued")
             else:
                 issue.assign_to(username)
                 ts.ok(f"Issue assigned to {username}")
@@ -91,6 +114,33 @@ def assign_issue(lancet, issue, username, active_status):
             ts.ok(f"Issue already assigned to {username}")
 
 
+def report_tracker_queue(lancet):
+    queue = lancet.tracker_queue
+    if queue is None:
+        return
+
+    reported = []
+    for intent, result in queue.unreported():
+        if not reported:
+            click.secho(
+                "Some queued issue tracker updates could not be applied:",
+                fg="yellow",
+                bold=True,
+            )
+        click.echo(
+            " {} Could not {}: {}".format(
+                click.style("✗", fg="red"),
+                intent.describe(),
+                result["message"],
+            )
+        )
+        reported.append(intent)
+
+    if reported:
+        click.echo()
+        queue.mark_reported(reported)
+
+
 def assign_pull_request(lancet, pr, username):
     with taskstatus(f"Assigning pull request to {username}") as ts:
         if not pr.assignees or username not in pr.assignees:
@@ -108,11 +158,174 @@ def get_branch(lancet, issue, base_branch=None, create=True):
     name_getter = lancet.get_instance_from_config(
         "repository", "branch_name_getter", lancet
     )
-    branch_getter = BranchGetter(base_branch, name_getter, remote_name)
+    branch_getter = BranchGetter(
+        base_branch,
+        name_getter,
+        remote_name,
+        callbacks=lancet.get_remote_callbacks(),
+        fetch_depth=lancet.config.getint("repository", "fetch_depth"),
+    )
 
     return branch_getter(lancet.repo, issue, create=create)
 
 
+def get_issue_keys(lancet, issue_key):
+    """Return the forms an issue key can have, with or without its project."""
+    issue_keys = {str(issue_key)}
+    project_id = lancet.config.get("tracker", "project_id", fallback=None)
+    if project_id and str(issue_key).isdigit():
+        issue_keys.add(f"{project_id}-{issue_key}")
+    return issue_keys
+
+
+def get_issue_key_pattern(lancet):
+    """
+    Return the compiled pattern matching the issue keys mentioned in commit
+    messages, as configured for the repository or else for the tracker (or
+    None if there is none).
+    """
+    pattern = lancet.config.get("repository", "issue_key_pattern")
+    if not pattern:
+        pattern = lancet.config.get(
+            lancet.get_config_section("tracker"),
+            "issue_key_pattern",
+            fallback=None,
+        )
+    if not pattern:
+        return None
+    project = lancet.config.get("tracker", "default_project", fallback=None)
+    # Without a default project, the keys of all projects are matched
+    project = re.escape(project) if project else "[A-Z][A-Z0-9]+"
+    return re.compile(pattern.replace("{project}", project))
+
+
+def find_local_branch(lancet, issue_key):
+    """
+    Find the local working branch of an issue from its key alone, without
+    contacting the issue tracker. Returns ``None`` unless exactly one local
+    branch matches.
+    """
+    name_getter = lancet.get_instance_from_config(
+        "repository", "branch_name_getter", lancet
+    )
+
+    names = set()
+    for key in get_issue_keys(lancet, issue_key):
+        for discriminator in name_getter.get_discriminators(key):
+            names.update(
+                iter_references(lancet.repo, "refs/heads/" + discriminator)
+            )
+
+    if len(names) != 1:
+        return None
+    return lancet.repo.lookup_branch(names.pop()[len("refs/heads/") :])
+
+
+def get_issue_index(lancet):
+    """
+    Return the index of the commits related to each issue, updated with the
+    commits added to the local and remote branches since the last call.
+    """
+    base_branch = lancet.config.get("repository", "base_branch")
+    remote_name = lancet.config.get("repository", "remote_name")
+    name_getter = lancet.get_instance_from_config(
+        "repository", "branch_name_getter", lancet
+    )
+    index = IssueIndex(
+        lancet.get_repo_cache_path("issues.json"),
+        get_issue_key_pattern(lancet),
+        name_getter,
+    )
+
+    branches = {}
+    for prefix in ("refs/heads/", "refs/remotes/"):
+        for ref_name in iter_references(lancet.repo, prefix):
+            target = lancet.repo.lookup_reference(ref_name).target
+            if isinstance(target, pygit2.Oid):
+                # Symbolic references such as origin/HEAD are skipped
+                branches[ref_name] = target
+
+    base = branches.get(f"refs/remotes/{remote_name}/{base_branch}")
+    if base is None:
+        base = branches.get(f"refs/heads/{base_branch}")
+
+    index.refresh(lancet.repo, branches, base)
+    return index
+
+
+def fetch_branches(lancet, ts, *branch_names):
+    """
+    Fetch the latest changes of the given branches only, with a single
+    fetch. Returns their remote-tracking references (None for the branches
+    which do not exist on the remote).
+    """
+    remote_name = lancet.config.get("repository", "remote_name")
+    remote = lancet.repo.lookup_remote(remote_name)
+    if not remote:
+        ts.abort('Remote "{}" not found', remote_name)
+    refspecs = [
+        "+refs/heads/{0}:refs/remotes/{1}/{0}".format(name, remote_name)
+        for name in branch_names
+    ]
+    fetch(remote, refspecs, lancet.get_remote_callbacks(), ts)
+    return [
+        lancet.repo.lookup_branch(
+            "{}/{}".format(remote_name, name), pygit2.GIT_BRANCH_REMOTE
+        )
+        for name in branch_names
+    ]
+
+
+def abort_on_conflicts(ts, base_branch, conflicts):
+    ts.fail('Conflicts with "{}" in {} files', base_branch, len(conflicts))
+    click.echo()
+    for path in conflicts:
+        click.echo(" {} {}".format(click.style("*", fg="red"), path))
+    click.echo()
+    click.echo("Please merge or rebase the working branch to continue.")
+    sys.exit(1)
+
+
+def check_mergeability(lancet, branch, base_branch):
+    """
+    Merge the up-to-date base branch into the working branch in memory and
+    abort if they conflict.
+    """
+    with taskstatus('Checking mergeability into "{}"', base_branch) as ts:
+        (base,) = fetch_branches(lancet, ts, base_branch)
+        if base is None:
+            ts.abort('Branch "{}" not found on the remote', base_branch)
+        result = merge_in_memory(
+            lancet.repo,
+            branch.target,
+            base.target,
+            MergeBaseCache(lancet.get_repo_cache_path("merge-bases.json")),
+        )
+        if result.conflicts:
+            abort_on_conflicts(ts, base_branch, result.conflicts)
+        ts.ok(
+            'Mergeable into "{}" ({} ahead, {} behind)',
+            base_branch,
+            result.ahead,
+            result.behind,
+        )
+
+
+def checkout_branch(lancet, branch):
+    """
+    Check out the given branch, or switch to its worktree if worktrees are
+    enabled. Returns the path of the worktree, if any.
+    """
+    pool = lancet.worktree_pool
+    if pool is None:
+        lancet.repo.checkout(branch.name)
+        return None
+
+    path = pool.activate(branch)
+    lancet.defer_to_shell("cd", path)
+    return path
+
+
 def get_project_keys(lancet):
     workspace = os.path.expanduser(lancet.config.get("lancet", "workspace"))
     config_files = glob.glob(os.path.join(workspace, "*", LOCAL_CONFIG))
@@ -129,3 +342,17 @@ def get_project_dirs(lancet):
     for path in glob.glob(os.path.join(workspace, "*", ".lancet")):
         path = os.path.dirname(path)
         yield os.path.basename(path), path
+
+
+def get_project_remotes(lancet):
+    """
+    Yield the name and the URL of the remote of each project of the
+    workspace. Only the local repositories are read.
+    """
+    remote_name = lancet.config.get("repository", "remote_name")
+    for name, path in get_project_dirs(lancet):
+        try:
+            remote = pygit2.Repository(path).remotes[remote_name]
+        except (KeyError, pygit2.GitError):
+            continue
+        yield name, remote.url
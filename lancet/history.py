@@ -0,0 +1,237 @@
+"""
+Indexes of the git history, kept up to date incrementally.
+"""
+
+import re
+from collections import OrderedDict
+
+import pygit2
+
+from .git import get_branch_name
+from .utils import JSONFile
+
+
+# Subjects of the merge commits created by git, GitLab and GitHub. The first
+# non-empty group holds the name of the merged branch.
+MERGED_BRANCH_PATTERN = re.compile(
+    r"^Merge branch '([^']+)'"
+    r"|^Merge remote-tracking branch '[^'/]+/([^']+)'"
+    r"|^Merge pull request #[0-9]+ from [^/\s]+/(\S+)"
+)
+
+
+def extract_issue_keys(pattern, message):
+    """
+    Yield the issue keys matched by a compiled pattern in a commit message.
+    The first non-empty group of each match holds the key, if there is any.
+    """
+    if pattern is None:
+        return
+    for match in pattern.finditer(message):
+        groups = [g for g in match.groups() if g]
+        yield groups[0] if groups else match.group(0)
+
+
+def get_range_issue_keys(repo, target, since, pattern, branch_name_getter):
+    """
+    Return the keys of the issues related to the commits reachable from
+    ``target`` but not from ``since`` (if given), and the number of commits.
+
+    Keys are taken from the commit messages and, for merge commits, from
+    the names of the merged branches.
+    """
+    walker = repo.walk(target, pygit2.GIT_SORT_NONE)
+    if since is not None:
+        walker.hide(since)
+
+    issue_keys = set()
+    count = 0
+    for count, commit in enumerate(walker, 1):
+        issue_keys.update(extract_issue_keys(pattern, commit.message))
+        if len(commit.parent_ids) > 1:
+            for branch_name in extract_issue_keys(
+                MERGED_BRANCH_PATTERN, commit.message.split("\n", 1)[0]
+            ):
+                issue_key = branch_name_getter.match_issue_key(branch_name)
+                if issue_key is not None:
+                    issue_keys.add(issue_key)
+    return issue_keys, count
+
+
+class HistoryIndex(JSONFile):
+    """
+    Index of the commits reachable from a set of tips.
+
+    Each update only walks the commits which were not reachable from the
+    tips of the previous update.
+    """
+
+    sorting = pygit2.GIT_SORT_NONE
+
+    def get_default(self):
+        return {"tips": []}
+
+    def is_incremental(self, repo, tips):
+        """Tell whether the entries of the previous updates are still valid."""
+        return True
+
+    def add_commit(self, commit):
+        raise NotImplementedError()
+
+    def update(self, repo, tips):
+        tips = sorted({str(tip) for tip in tips})
+        if tips == self.data["tips"]:
+            return False
+
+        if not self.is_incremental(repo, tips):
+            self._data = self.get_default()
+
+        walker = repo.walk(None, self.sorting)
+        for tip in tips:
+            walker.push(pygit2.Oid(hex=tip))
+        for tip in self.data["tips"]:
+            try:
+                walker.hide(pygit2.Oid(hex=tip))
+            except (KeyError, pygit2.GitError):
+                # The commit was garbage collected since the last update
+                pass
+
+        for commit in walker:
+            self.add_commit(commit)
+
+        self.data["tips"] = tips
+        self.save()
+        return True
+
+
+class ContributorIndex(HistoryIndex):
+    """
+    Authors of the commits reachable from HEAD, in the order in which they
+    first contributed, along with the email they used most recently.
+    """
+
+    sorting = pygit2.GIT_SORT_TIME | pygit2.GIT_SORT_REVERSE
+
+    def get_default(self):
+        return {"tips": [], "contributors": {}}
+
+    def is_incremental(self, repo, tips):
+        # Contributors of rewritten or unrelated history are not visible
+        # anymore and the whole history has to be walked again.
+        previous_tips = self.data["tips"]
+        if not previous_tips:
+            return True
+        previous_tip = pygit2.Oid(hex=previous_tips[0])
+        tip = pygit2.Oid(hex=tips[0])
+        try:
+            return repo.descendant_of(tip, previous_tip)
+        except (KeyError, pygit2.GitError):
+            return False
+
+    def add_commit(self, commit):
+        contributors = self.data["contributors"]
+        # Keep the position of the first contribution
+        contributors[commit.author.name] = commit.author.email
+
+    def get_contributors(self, repo):
+        """Return the contributors with the .mailmap of the repo applied."""
+        mailmap = pygit2.Mailmap.from_repository(repo)
+        contributors = OrderedDict()
+        for name, email in self.data["contributors"].items():
+            name, email = mailmap.resolve(name, email)
+            contributors[name] = email
+        return contributors
+
+
+class IssueIndex(HistoryIndex):
+    """
+    Commits related to each issue, stored as a sorted array of commit ids
+    per issue key.
+
+    Commits are related to the issues mentioned in their message, and to
+    the issue of the branches they were made on (the commits of a branch
+    which are not on the base branch).
+    """
+
+    def __init__(self, path, message_pattern, branch_name_getter):
+        super().__init__(path)
+        self.message_pattern = message_pattern
+        self.branch_name_getter = branch_name_getter
+        self._added = {}
+
+    def get_default(self):
+        return {"tips": [], "branches": {}, "issues": {}}
+
+    def _add(self, issue_key, oid):
+        self._added.setdefault(issue_key, set()).add(str(oid))
+
+    def add_commit(self, commit):
+        for issue_key in extract_issue_keys(
+            self.message_pattern, commit.message
+        ):
+            self._add(issue_key, commit.id)
+
+    def index_branches(self, repo, branches, base):
+        """
+        Relate the commits of each branch (a mapping of reference names to
+        tips) to the issue of the branch. Only the commits added since the
+        previous update are walked.
+        """
+        indexed = self.data["branches"]
+        changed = set(indexed) != set(branches)
+
+        for name, tip in branches.items():
+            issue_key = self.branch_name_getter.match_issue_key(
+                get_branch_name(name)
+            )
+            if issue_key is None or indexed.get(name) == str(tip):
+                continue
+            walker = repo.walk(tip, pygit2.GIT_SORT_NONE)
+            walker.hide(base)
+            if name in indexed:
+                try:
+                    walker.hide(pygit2.Oid(hex=indexed[name]))
+                except (KeyError, pygit2.GitError):
+                    # The previous tip was garbage collected
+                    pass
+            for commit in walker:
+                self._add(issue_key, commit.id)
+            indexed[name] = str(tip)
+            changed = True
+
+        for name in set(indexed) - set(branches):
+            del indexed[name]
+        return changed
+
+    def refresh(self, repo, branches, base):
+        """Index the commits added to the given branches since last time."""
+        # Without a base branch, the whole history would be related to the
+        # issue of each branch.
+        changed = base is not None and self.index_branches(
+            repo, branches, base
+        )
+        if not self.update(repo, branches.values()) and changed:
+            self.save()
+
+    def save(self):
+        issues = self.data["issues"]
+        for issue_key, oids in self._added.items():
+            issues[issue_key] = sorted(oids.union(issues.get(issue_key, [])))
+        self._added = {}
+        super().save()
+
+    def get_commits(self, repo, issue_keys):
+        """Return the known commits of the given issues, newest first."""
+        oids = set()
+        for issue_key in issue_keys:
+            oids.update(self.data["issues"].get(issue_key, []))
+
+        commits = []
+        for oid in oids:
+            try:
+                commits.append(repo[pygit2.Oid(hex=oid)])
+            except KeyError:
+                # Garbage collected after a rebase
+                pass
+        commits.sort(key=lambda c: c.commit_time, reverse=True)
+        return commits
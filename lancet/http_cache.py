@@ -0,0 +1,90 @@
+"""
+On-disk cache for API responses, revalidated with conditional requests.
+"""
+
+import os
+import json
+import hashlib
+
+from .utils import dump_json_atomically
+
+
+class ResponseCache:
+    """
+    Cache of decoded response payloads along with their validators.
+
+    Cached payloads are never served without asking the server first: the
+    ``ETag`` and ``Last-Modified`` validators are sent back and the payload
+    is only reused when the server answers ``304 Not Modified``.
+
+    Entries are stored one per file. The least recently used entries are
+    evicted once the total size exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, namespace, url, params=None):
+        params = sorted((params or {}).items())
+        data = json.dumps([namespace, url, params], default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as fh:
+                entry = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+        # The modification time tracks the last use for the LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def get_conditional_headers(self, entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["if-none-match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["if-modified-since"] = entry["last_modified"]
+        return headers
+
+    def store(self, key, response, payload):
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        if not etag and not last_modified:
+            return
+
+        dump_json_atomically(
+            self._path(key),
+            {"etag": etag, "last_modified": last_modified, "payload": payload},
+        )
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another thread or process in the meantime
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -22,6 +22,13 @@ class Tracker:
     def get_issue(self, project_id, issue_id):
         raise NotImplementedError
 
+    def get_issues(self, project_id, issue_ids):
+        """
+        Retrieve multiple issues with a single request. Issues which do not
+        exist are left out.
+        """
+        raise NotImplementedError
+
     def whoami(self):
         raise NotImplementedError
 
@@ -39,6 +46,7 @@ class Issue:
     assignees = notimplementedproperty()
     project = notimplementedproperty()
     is_subtask = notimplementedproperty()
+    is_closed = notimplementedproperty()
     link = notimplementedproperty()
 
     def get_transitions(self):
@@ -111,6 +119,17 @@ class GitlabTracker(Tracker):
         issue = project.issues.get(issue_id)
         return GitlabIssue(self, issue)
 
+    def get_issues(self, project_id, issue_ids):
+        if not issue_ids:
+            return []
+        # Keys of other trackers (e.g. ABC-12) cannot be GitLab issues
+        iids = [int(i) for i in issue_ids if str(i).isdigit()]
+        if not iids:
+            return []
+        project = self.api.projects.get(project_id, lazy=True)
+        issues = project.issues.list(iids=iids, all=True)
+        return [GitlabIssue(self, issue) for issue in issues]
+
     @cached_property
     def _current_user(self):
         self.api.auth()
@@ -188,6 +207,10 @@ class GitlabIssue(Issue):
     def is_subtask(self):
         return False
 
+    @property
+    def is_closed(self):
+        return self.issue.state == "closed"
+
     @cached_property
     def link(self):
         return self.issue.web_url
@@ -218,7 +241,11 @@ def gitlab(lancet, config_section):
     from gitlab import Gitlab as GitlabAPI
 
     url, username, private_token = lancet.get_credentials(config_section)
-    api = GitlabAPI(url, private_token=private_token)
+    api = GitlabAPI(
+        url,
+        private_token=private_token,
+        session=lancet.transport.create_session(),
+    )
     group_id = lancet.config.get("tracker", "group_id")
     return GitlabTracker(api, group_id)
 
@@ -247,6 +274,21 @@ class JIRATracker(Tracker):
             issue_id = f"{project_id}-{issue_id}"
         return JIRAIssue(self, self.api.issue(issue_id))
 
+    def get_issues(self, project_id, issue_ids):
+        if not issue_ids:
+            return []
+        keys = [
+            i if "-" in i else f"{project_id}-{i}" for i in map(str, issue_ids)
+        ]
+        # Without validation, unknown keys are ignored instead of failing
+        # the whole search
+        issues = self.api.search_issues(
+            "key in ({})".format(", ".join(keys)),
+            maxResults=len(keys),
+            validate_query=False,
+        )
+        return [JIRAIssue(self, issue) for issue in issues]
+
     def whoami(self):
         return self.api.current_user()
 
@@ -301,6 +343,10 @@ class JIRAIssue(Issue):
     def is_subtask(self):
         return self.issue.fields.issuetype.subtask
 
+    @property
+    def is_closed(self):
+        return self.issue.fields.status.statusCategory.key == "done"
+
     @cached_property
     def link(self):
         return self.issue.permalink()
@@ -340,19 +386,29 @@ class JIRAIssue(Issue):
 def jira(lancet, config_section):
     from jira import JIRA, JIRAError
 
+    timeout = lancet.transport.timeout
+
     def checker(url, username, password):
         try:
-            JIRA(options={"server": url}, basic_auth=(username, password))
+            api = JIRA(
+                options={"server": url},
+                basic_auth=(username, password),
+                timeout=timeout,
+            )
         except JIRAError:
             return False
         else:
+            api.close()
             return True
 
     url, username, api_token = lancet.get_credentials(config_section, checker)
     api = JIRA(
         options={"server": url, "agile_rest_path": "agile"},
         basic_auth=(username, api_token),
+        timeout=timeout,
     )
+    # Share the keep-alive pools of the other backends
+    lancet.transport.mount(api._session)
     board_id = lancet.config.get("tracker", "board_id")
     lancet.call_on_close(api.close)
     return JIRATracker(api, board_id)
@@ -0,0 +1,177 @@
+"""
+Client-side rate limiting for the web APIs lancet talks to.
+"""
+
+import json
+import time
+import fcntl
+import random
+import itertools
+import threading
+import contextlib
+
+import requests
+
+
+class TokenBucket:
+    """
+    Token bucket allowing ``capacity`` requests in a burst, refilled at
+    ``rate`` requests per second.
+
+    The bucket is shared between the threads of the current process and, if
+    a ``path`` is given, between all processes using the same file.
+    """
+
+    def __init__(self, rate, capacity, path=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.path = path
+        self.stats = {
+            "requests": 0,
+            "throttled_requests": 0,
+            "throttled_seconds": 0.0,
+        }
+        self._lock = threading.Lock()
+        self._state = self._initial_state()
+
+    def _initial_state(self):
+        return {
+            "tokens": self.capacity,
+            "updated": time.time(),
+            "blocked_until": 0,
+        }
+
+    @contextlib.contextmanager
+    def _shared_state(self):
+        with self._lock:
+            if self.path is None:
+                yield self._state
+                return
+
+            with open(self.path, "a+") as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                fh.seek(0)
+                try:
+                    state = json.load(fh)
+                except ValueError:
+                    state = self._initial_state()
+                yield state
+                fh.seek(0)
+                fh.truncate()
+                json.dump(state, fh)
+
+    def _take(self, state):
+        now = time.time()
+        if state["blocked_until"] > now:
+            return state["blocked_until"] - now
+
+        elapsed = max(now - state["updated"], 0)
+        state["tokens"] = min(
+            self.capacity, state["tokens"] + elapsed * self.rate
+        )
+        state["updated"] = now
+
+        if state["tokens"] >= 1:
+            state["tokens"] -= 1
+            return 0
+        return (1 - state["tokens"]) / self.rate
+
+    def acquire(self):
+        """Block until a request can be made."""
+        throttled = False
+        while True:
+            with self._shared_state() as state:
+                wait = self._take(state)
+            if not wait:
+                break
+            throttled = True
+            with self._lock:
+                self.stats["throttled_seconds"] += wait
+            time.sleep(wait)
+
+        with self._lock:
+            self.stats["requests"] += 1
+            if throttled:
+                self.stats["throttled_requests"] += 1
+
+    def try_acquire(self):
+        """Take a token if one is available right away, without blocking."""
+        with self._shared_state() as state:
+            acquired = not self._take(state)
+        if acquired:
+            with self._lock:
+                self.stats["requests"] += 1
+        return acquired
+
+    def block(self, seconds):
+        """Hold back all requests for the given amount of seconds."""
+        with self._shared_state() as state:
+            state["blocked_until"] = max(
+                state["blocked_until"], time.time() + seconds
+            )
+            state["tokens"] = 0
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_retry_after(response):
+    """Return the delay requested by a ``Retry-After`` header, if any."""
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        # HTTP-date values are not used by the APIs we talk to
+        return None
+
+
+def send_with_retries(send, rate_limiter, max_retries, idempotent=True):
+    """
+    Send a request with ``send`` (a callable returning the response) once
+    the rate limiter allows it.
+
+    Throttled requests (429) were not processed and are retried whatever
+    they are; transient failures (connection errors, 502, 503 and 504) are
+    only retried for ``idempotent`` requests.
+    """
+    for attempt in itertools.count():
+        rate_limiter.acquire()
+        can_retry = attempt < max_retries
+        try:
+            r = send()
+        except requests.ConnectionError:
+            if can_retry and idempotent:
+                time.sleep(backoff_delay(attempt))
+                continue
+            raise
+
+        if r.status_code == 429 and can_retry:
+            delay = get_retry_after(r)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            rate_limiter.block(delay + backoff_delay(0))
+            continue
+        if r.status_code in (502, 503, 504) and can_retry and idempotent:
+            time.sleep(get_retry_after(r) or backoff_delay(attempt))
+            continue
+        return r
+
+
+def get_poll_interval(
+    previous, changed, remaining=None, minimum=5, maximum=60
+):
+    """
+    Return the delay before polling a resource again.
+
+    The delay is reset to ``minimum`` after a change and doubles while
+    nothing changes. When the resource is expected to change in
+    ``remaining`` seconds, the next poll is scheduled no later than that.
+    """
+    interval = minimum if changed else min(previous * 2, maximum)
+    if remaining is not None and remaining >= 0:
+        interval = min(interval, max(remaining, minimum))
+    return interval
@@ -1,12 +1,26 @@
+import datetime
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
 import attr
-from urllib.parse import quote as urlquote
+from urllib.parse import quote as urlquote, urlparse
 
 from giturlparse import parse as giturlparse
 
-from gitlab.exceptions import GitlabCreateError
+from gitlab.exceptions import GitlabCreateError, GitlabError, GitlabGetError
+
+from .utils import JSONFile
+from .ratelimit import TokenBucket, send_with_retries
 
 
 class SCMManager:
+    def get_pull_request(self, branch, base_branch):
+        raise NotImplementedError
+
+    def get_review_requests(self, assigned=False):
+        raise NotImplementedError
+
     def create_pull_request(self, branch, base_branch, summary, description):
         raise NotImplementedError
 
@@ -16,6 +30,10 @@ class PullRequest:
     def link(self):
         raise NotImplementedError
 
+    @property
+    def assignees(self):
+        raise NotImplementedError
+
     def assign_to(self, username):
         raise NotImplementedError
 
@@ -25,20 +43,285 @@ class PullRequestAlreadyExists(Exception):
     pull_request = attr.ib()
 
 
+# Pipeline statuses after which nothing changes without user intervention
+FINISHED_PIPELINE_STATUSES = {
+    "success",
+    "failed",
+    "canceled",
+    "skipped",
+    "manual",
+}
+
+
+def parse_timestamp(value):
+    if value is None:
+        return None
+    # datetime.fromisoformat only accepts the Z suffix on python 3.11+
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+@attr.s
+class PipelineStatus:
+    """Latest pipeline of a merge request, along with its jobs."""
+
+    branch = attr.ib()
+    pipeline = attr.ib()
+    jobs = attr.ib()
+    # Duration of the last finished pipeline, if any
+    previous_duration = attr.ib(default=None)
+    # Whether anything changed since the previous poll
+    changed = attr.ib(default=True)
+
+    @property
+    def is_finished(self):
+        return self.pipeline["status"] in FINISHED_PIPELINE_STATUSES
+
+    @property
+    def remaining(self):
+        """Seconds until the pipeline is expected to complete, if known."""
+        started_at = parse_timestamp(self.pipeline.get("started_at"))
+        if self.is_finished or not started_at or not self.previous_duration:
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc)
+        elapsed = (now - started_at).total_seconds()
+        return self.previous_duration - elapsed
+
+
+class GitlabProjectCache(JSONFile):
+    """
+    IDs of the GitLab projects, by remote URL. Entries of remotes whose URL
+    changed are simply not looked up anymore.
+    """
+
+
+def get_project_path(remote_url):
+    project_path = giturlparse(remote_url).pathname.strip("/")
+    if project_path.endswith(".git"):
+        project_path = project_path[:-4]
+    return project_path
+
+
+def is_not_found(error):
+    return getattr(error, "response_code", None) == 404
+
+
 @attr.s
 class GitlabSCMManager(SCMManager):
     api = attr.ib()
     repo = attr.ib()
     remote_name = attr.ib()
+    project_cache = attr.ib(default=None)
+    rate_limiter = attr.ib(default=None)
+    response_cache = attr.ib(default=None)
+    # Open pull requests by (source branch, target branch)
+    _open_pull_requests = attr.ib(
+        default=attr.Factory(dict), init=False, repr=False
+    )
+
+    # Default limit of GitLab.com for authenticated API requests
+    rate_limit = (2000 / 60, 100)
+
+    # Requests sent in parallel to retrieve the status of a pipeline
+    max_concurrent_requests = 3
+    max_retries = 3
+
+    def __attrs_post_init__(self):
+        if self.rate_limiter is None:
+            self.rate_limiter = TokenBucket(*self.rate_limit)
+
+    def _send(self, url, params=None, headers=None):
+        # The options of the client carry its authentication (the token is
+        # not part of its headers).
+        options = self.api._get_session_opts()
+        options["headers"].update(headers or {})
+        return send_with_retries(
+            functools.partial(
+                self.api.session.get, url, params=params, **options
+            ),
+            self.rate_limiter,
+            self.max_retries,
+        )
+
+    def _get(self, path, params=None):
+        """
+        Send a conditional GET request to the API. Returns the payload and
+        whether it changed since the previous request.
+        """
+        url = "{}/{}".format(self.api.api_url, path)
+        cache_key, cached, headers = None, None, None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.key(self.api.url, url, params)
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                headers = self.response_cache.get_conditional_headers(cached)
+
+        r = self._send(url, params=params, headers=headers)
+        if r.status_code == 304 and cached:
+            return cached["payload"], False
+        if r.status_code != 200:
+            raise GitlabGetError(r.text, r.status_code)
+
+        payload = r.json()
+        if cache_key:
+            self.response_cache.store(cache_key, r, payload)
+        return payload, True
+
+    def _paginate(self, path, params=None):
+        params = dict(params or {}, per_page=100)
+        for page in itertools.count(1):
+            records, _ = self._get(path, dict(params, page=page))
+            yield from records
+            if len(records) < params["per_page"]:
+                break
+
+    def get_review_requests(self, assigned=False):
+        """
+        Return the open merge requests of all projects awaiting a review of
+        the current user, or assigned to them.
+        """
+        if assigned:
+            params = {"scope": "assigned_to_me"}
+        else:
+            user, _ = self._get("user")
+            params = {"scope": "all", "reviewer_username": user["username"]}
+        params.update(state="opened", order_by="updated_at")
+        return list(self._paginate("merge_requests", params))
+
+    def get_pipeline_status(self, source_branch, target_branch):
+        """
+        Return the status of the latest pipeline of the merge request between
+        two branches, or None if there is no such pipeline.
+        """
+        pull_request = self.get_pull_request(source_branch, target_branch)
+        if pull_request is None:
+            return None
+
+        remote_url = self.repo.lookup_remote(self.remote_name).url
+        project_path = "projects/{}".format(self.get_project_id(remote_url))
+        pipelines, changed = self._get(
+            "{}/merge_requests/{}/pipelines".format(
+                project_path, pull_request.merge_request.iid
+            )
+        )
+        if not pipelines:
+            return None
+
+        latest = pipelines[0]
+        previous = next(
+            (
+                p
+                for p in pipelines[1:]
+                if p["status"] in FINISHED_PIPELINE_STATUSES
+            ),
+            None,
+        )
+        pipeline_path = "{}/pipelines/{}".format(project_path, latest["id"])
+
+        with ThreadPoolExecutor(self.max_concurrent_requests) as executor:
+            pipeline = executor.submit(self._get, pipeline_path)
+            jobs = executor.submit(
+                self._get, pipeline_path + "/jobs", {"per_page": 100}
+            )
+            if previous is not None:
+                # Finished pipelines do not change anymore and are served
+                # from the cache after the first request.
+                previous = executor.submit(
+                    self._get,
+                    "{}/pipelines/{}".format(project_path, previous["id"]),
+                )
+            pipeline, pipeline_changed = pipeline.result()
+            jobs, jobs_changed = jobs.result()
+            if previous is not None:
+                previous = previous.result()[0]
+
+        return PipelineStatus(
+            source_branch,
+            pipeline,
+            jobs,
+            previous_duration=previous["duration"] if previous else None,
+            changed=changed or pipeline_changed or jobs_changed,
+        )
+
+    def get_project_id(self, remote_url):
+        if self.project_cache is not None:
+            project_id = self.project_cache.data.get(remote_url)
+            if project_id is not None:
+                return project_id
+
+        project_path = get_project_path(remote_url)
+        project_id = self.api.projects.get(urlquote(project_path)).id
+
+        if self.project_cache is not None:
+            self.project_cache.data[remote_url] = project_id
+            self.project_cache.save()
+        return project_id
+
+    def forget_project_id(self, remote_url):
+        if self.project_cache is not None:
+            self.project_cache.data.pop(remote_url, None)
+            self.project_cache.save()
+
+    def with_project(self, callback):
+        """
+        Call ``callback`` with a lazy object for the project of the remote,
+        resolving the project again if it was not found with a cached ID.
+        """
+        remote_url = self.repo.lookup_remote(self.remote_name).url
+        cached = (
+            self.project_cache is not None
+            and remote_url in self.project_cache.data
+        )
+        try:
+            project_id = self.get_project_id(remote_url)
+            return callback(self.api.projects.get(project_id, lazy=True))
+        except GitlabError as e:
+            if not cached or not is_not_found(e):
+                raise
+        # The project was deleted or recreated since it was cached
+        self.forget_project_id(remote_url)
+        project_id = self.get_project_id(remote_url)
+        return callback(self.api.projects.get(project_id, lazy=True))
+
+    def get_pull_request(self, source_branch, target_branch):
+        return self.with_project(
+            lambda project: self.find_pull_request(
+                project, source_branch, target_branch
+            )
+        )
 
     def create_pull_request(
         self, source_branch, target_branch, summary, description
     ):
-        remote = self.repo.lookup_remote(self.remote_name)
-        project_path = giturlparse(remote.url).pathname
-        if project_path.endswith(".git"):
-            project_path = project_path[:-4]
-        prj = self.api.projects.get(urlquote(project_path))
+        return self.with_project(
+            lambda project: self._create_pull_request(
+                project, source_branch, target_branch, summary, description
+            )
+        )
+
+    def find_pull_request(self, project, source_branch, target_branch):
+        """Return the open pull request between two branches, if any."""
+        key = (source_branch, target_branch)
+        if key not in self._open_pull_requests:
+            merge_requests = project.mergerequests.list(
+                state="opened",
+                source_branch=source_branch,
+                target_branch=target_branch,
+                per_page=1,
+            )
+            self._open_pull_requests[key] = (
+                GitlabPullRequest(self, merge_requests[0])
+                if merge_requests
+                else None
+            )
+        return self._open_pull_requests[key]
+
+    def _create_pull_request(
+        self, prj, source_branch, target_branch, summary, description
+    ):
+        existing = self.find_pull_request(prj, source_branch, target_branch)
+        if existing is not None:
+            raise PullRequestAlreadyExists(existing)
+
         try:
             mr = prj.mergerequests.create(
                 {
@@ -50,10 +333,19 @@ class GitlabSCMManager(SCMManager):
                 }
             )
         except GitlabCreateError as e:
-            if e.error_message and "already exists" in e.error_message[0]:
-                # TODO: fetch PR and pass in
-                raise PullRequestAlreadyExists(None)
-        return GitlabPullRequest(self, mr)
+            if "already exists" in str(e.error_message):
+                # Created concurrently since the lookup
+                del self._open_pull_requests[(source_branch, target_branch)]
+                existing = self.find_pull_request(
+                    prj, source_branch, target_branch
+                )
+                if existing is not None:
+                    raise PullRequestAlreadyExists(existing)
+            raise
+
+        pull_request = GitlabPullRequest(self, mr)
+        self._open_pull_requests[(source_branch, target_branch)] = pull_request
+        return pull_request
 
 
 @attr.s
@@ -65,6 +357,10 @@ class GitlabPullRequest(PullRequest):
     def link(self):
         return self.merge_request.web_url
 
+    @property
+    def assignees(self):
+        return [a["username"] for a in self.merge_request.assignees or []]
+
     def assign_to(self, username):
         user = self.manager.api.users.list(username=username)[0]
         self.merge_request.assignee_id = user.id
@@ -75,7 +371,24 @@ def gitlab(lancet, config_section):
     from gitlab import Gitlab as GitlabAPI
 
     url, username, private_token = lancet.get_credentials(config_section)
-    api = GitlabAPI(url, private_token=private_token)
+    session = lancet.transport.create_session()
+    api = GitlabAPI(url, private_token=private_token, session=session)
+    project_cache = GitlabProjectCache(
+        lancet.get_cache_path("gitlab-projects.json")
+    )
+    # The limit is shared by all the processes using the same server
+    rate_limiter = TokenBucket(
+        *GitlabSCMManager.rate_limit,
+        path=lancet.get_cache_path(
+            "gitlab", "{}.ratelimit".format(urlparse(url).netloc)
+        ),
+    )
+    session.rate_limiter = rate_limiter
     return GitlabSCMManager(
-        api, lancet.repo, lancet.config.get("repository", "remote_name")
+        api,
+        lancet.repo,
+        lancet.config.get("repository", "remote_name"),
+        project_cache,
+        rate_limiter=rate_limiter,
+        response_cache=lancet.response_cache,
     )
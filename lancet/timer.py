@@ -1,9 +1,17 @@
+import json
+import time
+import functools
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from urllib.parse import urljoin
 
-from .utils import cached_property
+from .utils import cached_property, JSONFile
+from .ratelimit import TokenBucket, send_with_retries
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import attr
 
@@ -14,39 +22,227 @@ class HarvestError(Exception):
     message = attr.ib()
 
 
+class HarvestStore(JSONFile):
+    """
+    On-disk copy of the Harvest projects and task assignments.
+
+    Every synchronization only requests the records updated since the most
+    recent ``updated_at`` value seen so far. Records deleted on Harvest are
+    not reported by the API; remove the store file to force a full sync.
+    """
+
+    _synced = False
+
+    def get_default(self):
+        return {"projects": {}, "task_assignments": {}}
+
+    def _update(self, api, key):
+        records = self.data[key]
+        params = None
+        if records:
+            updated_since = max(r["updated_at"] for r in records.values())
+            params = {"updated_since": updated_since}
+        changed = False
+        for record in api._paginate(key, key, params=params):
+            records[str(record["id"])] = record
+            changed = True
+        return changed
+
+    def sync(self, api):
+        if not self._synced:
+            changed = self._update(api, "projects")
+            changed = self._update(api, "task_assignments") or changed
+            if changed:
+                self.save()
+            self._synced = True
+        return self.data
+
+    def projects(self, api):
+        return list(self.sync(api)["projects"].values())
+
+    def task_assignments(self, api, project_id):
+        for assignment in self.sync(api)["task_assignments"].values():
+            if assignment["project"]["id"] == project_id:
+                yield assignment
+
+
+class MappingCache(JSONFile):
+    """
+    Persistent memo of the Harvest project and task resolved for an issue.
+
+    Resolving them can require several requests to both the issue tracker
+    and Harvest; entries older than ``ttl`` seconds are resolved again.
+    """
+
+    def __init__(self, path, ttl):
+        super().__init__(path)
+        self.ttl = ttl
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry and time.time() - entry["resolved_at"] < self.ttl:
+            return entry["project_id"], entry["task_id"]
+
+    def set(self, key, project_id, task_id):
+        self.data[key] = {
+            "project_id": project_id,
+            "task_id": task_id,
+            "resolved_at": time.time(),
+        }
+        self.save()
+
+
+class TimeEntryIndex(JSONFile):
+    """
+    Today's time entries touched by lancet, keyed by external reference.
+    """
+
+    def get_default(self):
+        return {"date": None, "entries": {}}
+
+    @property
+    def entries(self):
+        today = date.today().isoformat()
+        if self.data["date"] != today:
+            self.data.update(date=today, entries={})
+        return self.data["entries"]
+
+    def get(self, group_id, issue_id):
+        return self.entries.get(f"{group_id}:{issue_id}")
+
+    def add(self, entry):
+        ext = entry.get("external_reference")
+        if ext and entry["spent_date"] == date.today().isoformat():
+            self.entries[f"{ext['group_id']}:{ext['id']}"] = entry["id"]
+            self.save()
+
+    def discard(self, group_id, issue_id):
+        if self.entries.pop(f"{group_id}:{issue_id}", None) is not None:
+            self.save()
+
+
 class HarvestAPI:
-    def __init__(self, server, basic_auth):
+    # Maximum page size accepted by the API
+    per_page = 2000
+
+    # Number of pages fetched in parallel once the page count is known
+    max_concurrent_pages = 4
+
+    # Published limit: 100 requests per 15 seconds for each access token
+    rate_limit = (100 / 15, 100)
+
+    # Methods which can safely be repeated after a failure
+    idempotent_methods = {"get", "head", "options", "put", "delete"}
+    max_retries = 3
+
+    def __init__(
+        self,
+        server,
+        basic_auth,
+        store=None,
+        entry_index=None,
+        rate_limiter=None,
+        session=None,
+        response_cache=None,
+    ):
         self.server = server
+        self.account_id = basic_auth[0]
+        self.response_cache = response_cache
+        self.store = store
+        self.entry_index = entry_index
+        if rate_limiter is None:
+            rate_limiter = TokenBucket(*self.rate_limit)
+        self.rate_limiter = rate_limiter
         self._projects = None
-        self._session = requests.Session()
-        self._session.headers = {
-            "user-agent": "lancet",
-            "accept": "application/json",
-            "content-type": "application/json",
-            "harvest-account-id": basic_auth[0],
-            "authorization": f"bearer {basic_auth[1]}",
-        }
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=self.max_concurrent_pages)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self._session = session
+        self._session.headers.update(
+            {
+                "user-agent": "lancet",
+                "accept": "application/json",
+                "content-type": "application/json",
+                "harvest-account-id": basic_auth[0],
+                "authorization": f"bearer {basic_auth[1]}",
+            }
+        )
 
     def _paginate(self, url, key, params=None):
-        while url:
-            page = self._request("get", url, params=params)
-            yield from page[key]
-            url = page["links"]["next"]
+        params = dict(params or {}, per_page=self.per_page)
+        page = self._request("get", url, params=params)
+        yield from page[key]
+
+        def fetch(page_number):
+            page_params = dict(params, page=page_number)
+            return self._request("get", url, params=page_params)[key]
+
+        # Keep a bounded window of in-flight requests and yield the records
+        # in page order; a consumer stopping early only wastes the window.
+        page_numbers = iter(range(2, (page["total_pages"] or 1) + 1))
+        with ThreadPoolExecutor(self.max_concurrent_pages) as executor:
+            pending = collections.deque(
+                executor.submit(fetch, n)
+                for n in itertools.islice(
+                    page_numbers, self.max_concurrent_pages
+                )
+            )
+            while pending:
+                records = pending.popleft().result()
+                for n in itertools.islice(page_numbers, 1):
+                    pending.append(executor.submit(fetch, n))
+                yield from records
+
+    def _send(self, method, url, params=None, json=None, headers=None):
+        return send_with_retries(
+            functools.partial(
+                self._session.request,
+                method,
+                urljoin(self.server, url),
+                params=params,
+                json=json,
+                headers=headers,
+            ),
+            self.rate_limiter,
+            self.max_retries,
+            idempotent=method in self.idempotent_methods,
+        )
 
     def _request(self, method, url, params=None, json=None):
-        r = self._session.request(
-            method, urljoin(self.server, url), params=params, json=json
-        )
+        cache_key, cached, headers = None, None, None
+        if method == "get" and self.response_cache is not None:
+            cache_key = self.response_cache.key(self.account_id, url, params)
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                headers = self.response_cache.get_conditional_headers(cached)
+
+        r = self._send(method, url, params=params, json=json, headers=headers)
+        if r.status_code == 304 and cached:
+            return cached["payload"]
+
         payload = r.json()
         if r.status_code not in [200, 201]:
-            raise HarvestError(payload["error"], payload["error_description"])
+            raise HarvestError(
+                payload["error"], payload.get("error_description")
+            )
+        if cache_key:
+            self.response_cache.store(cache_key, r, payload)
         return payload
 
+    def _index_entry(self, entry):
+        if self.entry_index is not None:
+            self.entry_index.add(entry)
+        return entry
+
     def restart(self, id):
-        return self._request("patch", f"time_entries/{id}/restart")
+        entry = self._request("patch", f"time_entries/{id}/restart")
+        return self._index_entry(entry)
 
     def stop(self, id):
-        return self._request("patch", f"time_entries/{id}/stop")
+        entry = self._request("patch", f"time_entries/{id}/stop")
+        return self._index_entry(entry)
 
     def pause(self, id=None):
         for entry in self.daily(is_running=True):
@@ -66,18 +262,26 @@ class HarvestAPI:
 
     def projects(self):
         if not self._projects:
-            self._projects = list(self._paginate("projects", "projects"))
+            if self.store is not None:
+                self._projects = self.store.projects(self)
+            else:
+                self._projects = list(self._paginate("projects", "projects"))
         return self._projects
 
     def tasks(self, project_id):
-        for assignment in self._paginate(
-            f"projects/{project_id}/task_assignments", "task_assignments"
-        ):
+        if self.store is not None:
+            assignments = self.store.task_assignments(self, project_id)
+        else:
+            assignments = self._paginate(
+                f"projects/{project_id}/task_assignments", "task_assignments"
+            )
+        for assignment in assignments:
             yield assignment["task"]
 
-    def daily(self, is_running=None):
+    def daily(self, is_running=None, **extra_filters):
         today = date.today().isoformat()
         filters = {"from": today, "to": today, "user_id": self.user_id}
+        filters.update(extra_filters)
         if is_running is not None:
             filters["is_running"] = str(bool(is_running)).lower()
         return self._paginate("time_entries", "time_entries", params=filters)
@@ -87,46 +291,127 @@ class HarvestAPI:
 
 
 class HarvestPlatform(HarvestAPI):
-    def __init__(self, server, basic_auth, project_id_getter, task_id_getter):
+    def __init__(
+        self,
+        server,
+        basic_auth,
+        project_id_getter,
+        task_id_getter,
+        store=None,
+        mapping_cache=None,
+        entry_index=None,
+        rate_limiter=None,
+        session=None,
+        response_cache=None,
+    ):
         self.get_project_id = project_id_getter
         self.get_task_id = task_id_getter
-        super().__init__(server, basic_auth)
+        self.mapping_cache = mapping_cache
+        super().__init__(
+            server,
+            basic_auth,
+            store,
+            entry_index,
+            rate_limiter,
+            session=session,
+            response_cache=response_cache,
+        )
+
+    def get_mapping_key(self, issue):
+        get_epic_key = getattr(self.get_task_id, "get_epic_key", None)
+        epic_key = get_epic_key(issue) if get_epic_key else None
+        return json.dumps([str(issue.id), str(issue.type), epic_key])
+
+    def resolve(self, issue, memoized=True):
+        """
+        Return the Harvest (project_id, task_id) pair for an issue. Unless
+        ``memoized`` is false, a previously resolved pair is reused.
+        """
+        if memoized and self.mapping_cache is not None:
+            resolved = self.mapping_cache.get(self.get_mapping_key(issue))
+            if resolved:
+                return resolved
+
+        project_id = self.get_project_id(self, issue)
+        task_id = self.get_task_id(self, project_id, issue)
+
+        if self.mapping_cache is not None:
+            self.mapping_cache.set(
+                self.get_mapping_key(issue), project_id, task_id
+            )
+        return project_id, task_id
+
+    def find_entry(self, issue):
+        """
+        Return the most recent time entry of today linked to the given issue.
+
+        The entry recorded in the local index is verified first, otherwise
+        only the entries referencing the issue are requested from Harvest.
+        """
+        group_id, issue_id = str(issue.project.id), str(issue.id)
+
+        def matches(entry):
+            ext = entry.get("external_reference") or {}
+            return (
+                ext.get("group_id") == group_id and ext.get("id") == issue_id
+            )
+
+        if self.entry_index is not None:
+            entry_id = self.entry_index.get(group_id, issue_id)
+            if entry_id is not None:
+                try:
+                    entry = self._request("get", f"time_entries/{entry_id}")
+                except HarvestError:
+                    entry = None
+                if entry and matches(entry):
+                    return entry
+                self.entry_index.discard(group_id, issue_id)
+
+        for entry in self.daily(external_reference_id=issue_id):
+            if matches(entry):
+                return self._index_entry(entry)
 
     def start(self, issue, resume=True):
         if resume:
-            timers = list(self.daily())
-            for entry in reversed(timers):
-                ext = entry.get("external_reference", None)
-                if not ext:
-                    continue
-                if ext["group_id"] != str(issue.project.id):
-                    continue
-                if ext["id"] != str(issue.id):
-                    continue
-
+            entry = self.find_entry(issue)
+            if entry is not None:
                 if not entry["is_running"]:
                     self.restart(entry["id"])
                 return
 
         name = "{} - {}".format(issue.id, issue.summary)
-        project_id = self.get_project_id(self, issue)
-        task_id = self.get_task_id(self, project_id, issue)
-        self._request(
-            "post",
-            "time_entries",
-            json={
-                "external_reference": {
-                    "group_id": issue.project.id,
-                    "id": issue.id,
-                    "permalink": issue.link,
+
+        def create_entry(project_id, task_id):
+            return self._request(
+                "post",
+                "time_entries",
+                json={
+                    "external_reference": {
+                        "group_id": issue.project.id,
+                        "id": issue.id,
+                        "permalink": issue.link,
+                    },
+                    "hours": 0,
+                    "notes": name,
+                    "project_id": project_id,
+                    "task_id": task_id,
+                    "spent_date": date.today().isoformat(),
                 },
-                "hours": 0,
-                "notes": name,
-                "project_id": project_id,
-                "task_id": task_id,
-                "spent_date": date.today().isoformat(),
-            },
-        )
+            )
+
+        memoized = None
+        if self.mapping_cache is not None:
+            memoized = self.mapping_cache.get(self.get_mapping_key(issue))
+
+        try:
+            entry = create_entry(*(memoized or self.resolve(issue)))
+        except HarvestError:
+            if not memoized:
+                raise
+            # The memoized project or task may have been archived or
+            # unassigned in the meantime, resolve them again.
+            entry = create_entry(*self.resolve(issue, memoized=False))
+        self._index_entry(entry)
 
 
 class MappedProjectID:
@@ -186,10 +471,22 @@ class EpicTaskMapper:
     def __init__(self, epic_link_field, epic_name_field):
         self.epic_link_field = epic_link_field
         self.epic_name_field = epic_name_field
+        self._task_ids = {}
 
     def get_epic(self, issue):
         return issue.get_epic()
 
+    def get_epic_key(self, issue):
+        return getattr(issue.issue.fields, self.epic_link_field, None)
+
+    def get_task_ids(self, timer, project_id):
+        if project_id not in self._task_ids:
+            task_ids = {}
+            for t in timer.tasks(project_id):
+                task_ids.setdefault(t["name"], t["id"])
+            self._task_ids[project_id] = task_ids
+        return self._task_ids[project_id]
+
     def __call__(self, timer, project_id, issue):
         try:
             epic = self.get_epic(issue)
@@ -199,14 +496,13 @@ class EpicTaskMapper:
             )
         epic_name = getattr(epic.fields, self.epic_name_field)
 
-        for t in timer.tasks(project_id):
-            if t["name"] == epic_name:
-                return t["id"]
-
-        raise ValueError(
-            'Could not find a task with the name "{}" in the Harvest project '
-            "with ID {}".format(epic_name, project_id)
-        )
+        task_id = self.get_task_ids(timer, project_id).get(epic_name)
+        if task_id is None:
+            raise ValueError(
+                'Could not find a task with the name "{}" in the Harvest '
+                "project with ID {}".format(epic_name, project_id)
+            )
+        return task_id
 
 
 def epic_task_id_getter(lancet):
@@ -216,9 +512,9 @@ def epic_task_id_getter(lancet):
     )
 
 
-def credentials_checker(url, username, password):
+def credentials_checker(url, username, password, session=None):
     """Check the provided credentials using the Harvest API."""
-    api = HarvestAPI(url, (username, password))
+    api = HarvestAPI(url, (username, password), session=session)
     try:
         api.whoami()
     except HarvestError:
@@ -229,8 +525,11 @@ def credentials_checker(url, username, password):
 
 def harvest(lancet, config_section):
     """Construct a new Harvest client."""
+    # The same session is used to check the credentials and by the client,
+    # so that the connection opened by the check is reused.
+    session = lancet.transport.create_session()
     url, username, password = lancet.get_credentials(
-        config_section, credentials_checker
+        config_section, functools.partial(credentials_checker, session=session)
     )
 
     project_id_getter = lancet.get_instance_from_config(
@@ -240,11 +539,29 @@ def harvest(lancet, config_section):
         "timer", "task_id_getter", lancet
     )
 
+    store = HarvestStore(lancet.get_cache_path("harvest", f"{username}.json"))
+    rate_limiter = TokenBucket(
+        *HarvestPlatform.rate_limit,
+        path=lancet.get_cache_path("harvest", f"{username}.ratelimit"),
+    )
+    session.rate_limiter = rate_limiter
+
     client = HarvestPlatform(
         server=url,
         basic_auth=(username, password),
         project_id_getter=project_id_getter,
         task_id_getter=task_id_getter,
+        store=store,
+        mapping_cache=MappingCache(
+            lancet.get_cache_path("harvest", f"{username}-mappings.json"),
+            lancet.config.getint("timer", "mapping_ttl"),
+        ),
+        entry_index=TimeEntryIndex(
+            lancet.get_cache_path("harvest", f"{username}-today.json")
+        ),
+        rate_limiter=rate_limiter,
+        session=session,
+        response_cache=lancet.response_cache,
     )
     lancet.call_on_close(client.close)
     return client
@@ -0,0 +1,214 @@
+"""
+Write-behind queue for issue tracker mutations.
+
+Intents (assignments and status transitions) are appended to a journal in the
+cache directory and replayed by a background flusher, so that commands do not
+have to wait for the issue tracker to answer.
+"""
+
+import os
+import json
+import uuid
+import fcntl
+import contextlib
+
+import attr
+
+from .utils import run_in_background
+
+
+ASSIGN = "assign_to"
+TRANSITION = "apply_transition"
+
+APPLIED = "applied"
+SKIPPED = "skipped"
+CONFLICT = "conflict"
+RETRY = "retry"
+FAILED = "failed"
+
+
+@attr.s
+class Intent:
+    id = attr.ib()
+    action = attr.ib()
+    project_id = attr.ib()
+    issue_id = attr.ib()
+    value = attr.ib()
+
+    def describe(self):
+        if self.action == ASSIGN:
+            return f"assign {self.issue_id} to {self.value}"
+        else:
+            return f'set {self.issue_id} status to "{self.value}"'
+
+
+class TrackerQueue:
+    max_attempts = 3
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self._needs_flush = False
+        self._flushed = False
+
+    @contextlib.contextmanager
+    def _open(self, mode):
+        with open(self.path, mode) as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield fh
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _append(self, *records):
+        with self._open("a") as fh:
+            for record in records:
+                fh.write(json.dumps(record))
+                fh.write("\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        with self._open("r") as fh:
+            return self._parse(fh)
+
+    def _parse(self, fh):
+        return [json.loads(line) for line in fh if line.strip()]
+
+    def _state(self, records=None):
+        if records is None:
+            records = self._read()
+        intents, results, reported = {}, {}, set()
+        for record in records:
+            kind = record.pop("record")
+            if kind == "intent":
+                intents[record["id"]] = Intent(**record)
+            elif kind == "result":
+                results.setdefault(record["id"], []).append(record)
+            elif kind == "reported":
+                reported.add(record["id"])
+        return intents, results, reported
+
+    def enqueue(self, action, issue, value):
+        intent = Intent(
+            id=uuid.uuid4().hex,
+            action=action,
+            project_id=str(issue.project.id),
+            issue_id=str(issue.id),
+            value=value,
+        )
+        self._append(dict(attr.asdict(intent), record="intent"))
+        self._needs_flush = True
+        return intent
+
+    def pending(self):
+        intents, results, _ = self._state()
+        return [
+            intent
+            for intent in intents.values()
+            if all(r["outcome"] == RETRY for r in results.get(intent.id, []))
+        ]
+
+    def unreported(self):
+        """Return the (intent, result) pairs not yet shown to the user."""
+        intents, results, reported = self._state()
+        for intent_id, intent_results in results.items():
+            result = intent_results[-1]
+            if result["outcome"] not in (CONFLICT, FAILED):
+                continue
+            if intent_id in reported or intent_id not in intents:
+                continue
+            yield intents[intent_id], result
+
+    def mark_reported(self, intents):
+        self._append(*({"record": "reported", "id": i.id} for i in intents))
+        self.compact()
+
+    def compact(self):
+        """Truncate the journal once everything in it has been settled."""
+        if not os.path.exists(self.path):
+            return
+        # The journal is read and truncated under the same lock, so that no
+        # record appended by another process in between can be lost.
+        with self._open("r+") as fh:
+            intents, results, reported = self._state(self._parse(fh))
+            for intent_id in intents:
+                outcome = results.get(intent_id, [{"outcome": RETRY}])[-1]
+                if outcome["outcome"] == RETRY:
+                    return
+                if outcome["outcome"] in (CONFLICT, FAILED):
+                    if intent_id not in reported:
+                        return
+            fh.truncate(0)
+
+    def _replay(self, tracker, intent):
+        issue = tracker.get_issue(intent.project_id, intent.issue_id)
+
+        if intent.action == ASSIGN:
+            if intent.value in issue.assignees:
+                return SKIPPED, "Already assigned"
+            issue.assign_to(intent.value)
+            return APPLIED, None
+
+        if issue.status == intent.value:
+            return SKIPPED, "Already in the requested status"
+        transitions = issue.get_transitions(intent.value)
+        if len(transitions) != 1:
+            return CONFLICT, 'Found {} transitions from "{}" to "{}"'.format(
+                len(transitions), issue.status, intent.value
+            )
+        issue.apply_transition(transitions[0])
+        return APPLIED, None
+
+    def flush(self, tracker):
+        """Replay all pending intents, in order.
+
+        Only one flusher runs at a time; if another one holds the lock this
+        is a no-op. Replay stops at the first tracker error, so that the
+        remaining intents keep their relative order for the next attempt.
+        """
+        self._flushed = True
+        with open(self.lock_path, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            _, results, _ = self._state()
+            for intent in self.pending():
+                try:
+                    outcome, message = self._replay(tracker, intent)
+                except Exception as e:
+                    attempts = len(results.get(intent.id, [])) + 1
+                    outcome = (
+                        FAILED if attempts >= self.max_attempts else RETRY
+                    )
+                    self._append(
+                        {
+                            "record": "result",
+                            "id": intent.id,
+                            "outcome": outcome,
+                            "message": "{}: {}".format(type(e).__name__, e),
+                        }
+                    )
+                    break
+                self._append(
+                    {
+                        "record": "result",
+                        "id": intent.id,
+                        "outcome": outcome,
+                        "message": message,
+                    }
+                )
+            self.compact()
+
+    def flush_in_background(self):
+        # Intents left pending by a failed replay are retried by the next
+        # command, even if it did not queue anything itself.
+        if self._flushed:
+            return
+        if self._needs_flush or self.pending():
+            self._needs_flush = False
+            run_in_background("_flush-tracker-queue")
@@ -0,0 +1,244 @@
+"""
+HTTP transport shared by all the backends of a lancet invocation.
+"""
+
+import logging
+import threading
+import functools
+from urllib.parse import urlparse
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError,
+    wait,
+    FIRST_COMPLETED,
+)
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .deadline import Deadline
+from .utils import JSONFile
+
+
+logger = logging.getLogger(__name__)
+
+
+class TransportSession(requests.Session):
+    """
+    Session bound to a transport, applying its default timeouts and
+    accounting the requests it sends.
+
+    Clients throttling their requests set ``rate_limiter``, so that the
+    hedged copies of their requests are throttled as well.
+    """
+
+    def __init__(self, transport):
+        super().__init__()
+        self.transport = transport
+        self.rate_limiter = None
+
+    def request(self, method, url, **kwargs):
+        # Some clients explicitly pass timeout=None when not configured.
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.transport.timeout
+        send = functools.partial(super().request, method, url, **kwargs)
+        if method.upper() in ("GET", "HEAD") and not kwargs.get("stream"):
+            response = self.transport.hedge(
+                urlparse(url).netloc, send, self.rate_limiter
+            )
+        else:
+            response = send()
+        self.transport.record(response)
+        return response
+
+
+class DeadlineAdapter(HTTPAdapter):
+    """
+    Adapter capping the timeout of every request to the remaining budget
+    of the command.
+    """
+
+    def __init__(self, deadline, **kwargs):
+        self.deadline = deadline
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        timeout = self.deadline.cap(timeout)
+        try:
+            return super().send(request, timeout=timeout, **kwargs)
+        except (requests.Timeout, requests.ConnectionError):
+            # Report an exhausted budget instead of the low-level timeout
+            self.deadline.check()
+            raise
+
+    def close(self):
+        # Closing a session closes its adapters, but this one is shared by
+        # the sessions of all the backends: only the transport closes it.
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class LatencyLog(JSONFile):
+    """Most recent response times observed for each host."""
+
+    max_samples = 50
+
+    def add(self, host, elapsed):
+        samples = self.data.setdefault(host, [])
+        samples.append(elapsed)
+        del samples[: -self.max_samples]
+
+    def get_percentile(self, host, percentile, min_samples):
+        samples = sorted(self.data.get(host, []))
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile))
+        return samples[index]
+
+
+class Transport:
+    """
+    Keep-alive connection pools shared by all backends.
+
+    All sessions returned by ``create_session`` (or configured through
+    ``mount``) share the same pools, so a connection opened (and its DNS
+    lookup and TLS handshake done) by one backend is reused by the others.
+    """
+
+    # Reads are only hedged once enough response times were observed
+    min_hedge_samples = 10
+
+    def __init__(
+        self,
+        connect_timeout=5,
+        read_timeout=30,
+        pool_size=10,
+        connect_retries=2,
+        deadline=None,
+        latencies=None,
+        hedge=False,
+    ):
+        if deadline is None:
+            deadline = Deadline()
+        self.deadline = deadline
+        self.timeout = (connect_timeout, read_timeout)
+        retries = Retry(
+            total=None,
+            connect=connect_retries,
+            read=0,
+            status=0,
+            backoff_factor=0.2,
+        )
+        self.adapter = DeadlineAdapter(
+            deadline,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retries,
+        )
+        self.latencies = latencies
+        self._executor = ThreadPoolExecutor(pool_size) if hedge else None
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._hedged_requests = 0
+        self._elapsed = 0.0
+        self._sessions = []
+
+    def mount(self, session):
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        session.headers["accept-encoding"] = "gzip, deflate"
+        return session
+
+    def create_session(self):
+        session = self.mount(TransportSession(self))
+        self._sessions.append(session)
+        return session
+
+    def record(self, response):
+        elapsed = response.elapsed.total_seconds()
+        with self._lock:
+            self._requests += 1
+            self._elapsed += elapsed
+            if self.latencies is not None:
+                self.latencies.add(urlparse(response.url).netloc, elapsed)
+
+    def hedge(self, host, send, rate_limiter=None):
+        """
+        Send an idempotent request, and send it a second time if no response
+        arrived after the 95th percentile of the response times observed for
+        the host. The first successful response is returned.
+
+        The second request takes a token from the ``rate_limiter`` (if any)
+        and is not sent if none is available right away.
+        """
+        delay = None
+        if self._executor is not None and self.latencies is not None:
+            with self._lock:
+                delay = self.latencies.get_percentile(
+                    host, 0.95, self.min_hedge_samples
+                )
+        if delay is None:
+            return send()
+
+        first = self._executor.submit(send)
+        remaining = self.deadline.remaining()
+        try:
+            return first.result(
+                timeout=delay if remaining is None else min(delay, remaining)
+            )
+        except TimeoutError:
+            self.deadline.check()
+
+        if rate_limiter is not None and not rate_limiter.try_acquire():
+            return first.result()
+
+        with self._lock:
+            self._hedged_requests += 1
+        pending = {first, self._executor.submit(send)}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    return future.result()
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        connections = sum(
+            pools[key].num_connections for key in list(pools.keys())
+        )
+        return {
+            "requests": self._requests,
+            "connections": connections,
+            "reused_connections": max(self._requests - connections, 0),
+            "hedged_requests": self._hedged_requests,
+            "elapsed_seconds": self._elapsed,
+        }
+
+    def close(self):
+        logger.debug("Transport statistics: %r", self.stats())
+        for session in self._sessions:
+            if session.rate_limiter is not None:
+                logger.debug(
+                    "Rate limiter statistics (%s): %r",
+                    session.rate_limiter.path or "not shared",
+                    session.rate_limiter.stats,
+                )
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self.latencies is not None:
+            self.latencies.save()
+        self.adapter.shutdown()
+
+
+def from_config(config, deadline=None, latency_log_path=None):
+    return Transport(
+        connect_timeout=config.getfloat("lancet", "connect_timeout"),
+        read_timeout=config.getfloat("lancet", "read_timeout"),
+        pool_size=config.getint("lancet", "http_pool_size"),
+        deadline=deadline,
+        latencies=LatencyLog(latency_log_path) if latency_log_path else None,
+        hedge=config.getboolean("lancet", "hedge_requests"),
+    )
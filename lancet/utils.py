@@ -1,10 +1,13 @@
 import os
+import json
 import functools
 import sys
 import curses
+import subprocess
+import tempfile
 
 import click
-from jinja2 import Template
+from jinja2 import Environment, Template, meta
 
 from pkg_resources import resource_string
 
@@ -13,6 +16,47 @@ def cached_property(*args, **kwargs):
     return property(functools.lru_cache()(*args, **kwargs))
 
 
+class JSONFile:
+    """A JSON document stored on disk, loaded lazily and saved atomically."""
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+
+    def get_default(self):
+        return {}
+
+    @property
+    def data(self):
+        if self._data is None:
+            try:
+                with open(self.path) as fh:
+                    self._data = json.load(fh)
+            except (FileNotFoundError, ValueError):
+                self._data = self.get_default()
+        return self._data
+
+    def save(self):
+        dump_json_atomically(self.path, self.data)
+
+
+def dump_json_atomically(path, data):
+    """
+    Write a JSON document to ``path`` through a temporary file of its own, so
+    that concurrent processes neither see nor write a partial document.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 class PrintTaskStatus:
     _active_tasks = []
 
@@ -34,12 +78,15 @@ class PrintTaskStatus:
     def clear_line(cls):
         sys.stdout.buffer.write(cls.BOL + cls.CLEAR_EOL)
 
-    def __enter__(self):
-        PrintTaskStatus._active_tasks.append(self)
+    def _print_pending(self):
         msg = " {}  {}...".format(
             click.style("*", fg="yellow", blink=True), self.msg
         )
         click.echo(msg, nl=False)
+
+    def __enter__(self):
+        PrintTaskStatus._active_tasks.append(self)
+        self._print_pending()
         return self
 
     def __exit__(self, type, value, tb):
@@ -50,6 +97,11 @@ class PrintTaskStatus:
             else:
                 self.clear_line()
 
+    def update(self, msg, *args, **kwargs):
+        self.clear_line()
+        self.msg = msg.format(*args, **kwargs)
+        self._print_pending()
+
     def ok(self, msg, *args, **kwargs):
         self.clear_line()
         msg = msg.format(*args, **kwargs)
@@ -92,12 +144,41 @@ class SuspendTask:
 taskstatus = PrintTaskStatus
 
 
+def format_size(num_bytes):
+    for unit in ["bytes", "KiB", "MiB"]:
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024
+    else:
+        unit = "GiB"
+    return "{:.0f} {}".format(num_bytes, unit)
+
+
 def hr(char="─", width=None, **kwargs):
     if width is None:
         width = click.get_terminal_size()[0]
     click.secho("─" * width, **kwargs)
 
 
+def run_in_background(*args):
+    """Run a lancet subcommand in a detached process.
+
+    The process does not inherit the shell integration helper nor the
+    standard streams of the current command, and survives its exit.
+    """
+    env = dict(os.environ)
+    env.pop("LANCET_SHELL_HELPER", None)
+    subprocess.Popen(
+        [sys.executable, "-c", "from lancet.cli import main; main()"]
+        + list(args),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        start_new_session=True,
+    )
+
+
 def content_from_path(path, encoding="utf-8"):
     """Return the content of the specified file as a string.
 
@@ -120,6 +201,12 @@ def render_resource(resource_path, **context):
     return template.render(**context)
 
 
+def get_template_variables(resource_path):
+    """Return the names of the variables used by a template."""
+    ast = Environment().parse(content_from_path(resource_path))
+    return meta.find_undeclared_variables(ast)
+
+
 def edit_template(template_resource, **context):
     try:
         extension = template_resource.rsplit(".", 1)[1]
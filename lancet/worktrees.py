@@ -0,0 +1,136 @@
+"""
+Pool of git worktrees, one per issue branch.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+
+import pygit2
+
+from .git import get_common_dir
+from .utils import JSONFile
+
+
+class WorktreePool:
+    """
+    Check out each issue branch in its own worktree, so that switching
+    between issues does not rewrite the files of a single working tree.
+
+    Worktrees which were not used recently are pruned once there are more
+    than ``max_worktrees`` of them, as long as they have no local changes.
+
+    The untracked ``linked_paths`` of the main working tree (such as the
+    project configuration) are symlinked into each worktree.
+    """
+
+    def __init__(self, repo, directory, max_worktrees, linked_paths=()):
+        self.repo = repo
+        self.max_worktrees = max_worktrees
+        self.linked_paths = [p for p in linked_paths if p]
+
+        # Worktrees of different checkouts are kept apart, even if their
+        # directories have the same name.
+        main_workdir = os.path.dirname(get_common_dir(repo).rstrip("/"))
+        digest = hashlib.sha1(main_workdir.encode("utf-8")).hexdigest()[:8]
+        self.directory = os.path.join(
+            directory, "{}-{}".format(os.path.basename(main_workdir), digest)
+        )
+        self.main_workdir = main_workdir
+        os.makedirs(self.directory, exist_ok=True)
+        self.usage = JSONFile(os.path.join(self.directory, "usage.json"))
+
+    def get_worktree_name(self, branch):
+        return branch.branch_name.replace("/", "-")
+
+    def get_main_branch(self):
+        main_repo = pygit2.Repository(self.main_workdir)
+        if main_repo.head_is_detached or main_repo.head_is_unborn:
+            return None
+        return main_repo.head.name
+
+    def find_worktree(self, branch):
+        """Return the name of the worktree having the branch checked out."""
+        for name in self.repo.list_worktrees():
+            worktree = self.repo.lookup_worktree(name)
+            if worktree.is_prunable:
+                continue
+            try:
+                head = pygit2.Repository(worktree.path).head.name
+            except pygit2.GitError:
+                continue
+            if head == branch.name:
+                return name
+        return None
+
+    def link_paths(self, path):
+        for linked_path in self.linked_paths:
+            source = os.path.join(self.main_workdir, linked_path)
+            target = os.path.join(path, linked_path)
+            if os.path.exists(source) and not os.path.lexists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.symlink(source, target)
+
+    def activate(self, branch):
+        """Return the path of the worktree of a branch, creating it first."""
+        if branch.name == self.get_main_branch():
+            # Git does not allow to check out a branch twice
+            return self.main_workdir
+
+        # Branches are renamed when the summary of their issue changes
+        name = self.find_worktree(branch) or self.get_worktree_name(branch)
+        path = None
+        if name in self.repo.list_worktrees():
+            worktree = self.repo.lookup_worktree(name)
+            if worktree.is_prunable:
+                # The directory was removed by hand
+                worktree.prune(True)
+            else:
+                path = worktree.path
+        if path is None:
+            path = os.path.join(self.directory, name)
+            self.repo.add_worktree(name, path, branch)
+        self.link_paths(path)
+
+        self.usage.data[name] = time.time()
+        self.usage.save()
+        self.prune(keep=name)
+        return path
+
+    def is_clean(self, path):
+        try:
+            status = pygit2.Repository(path).status()
+        except pygit2.GitError:
+            return True
+        return all(
+            flags == pygit2.GIT_STATUS_IGNORED
+            or path.rstrip("/") in self.linked_paths
+            for path, flags in status.items()
+        )
+
+    def prune(self, keep=None):
+        """Remove the least recently used worktrees beyond the maximum."""
+        managed = [
+            (last_used, name)
+            for name, last_used in self.usage.data.items()
+            if name != keep
+        ]
+        excess = len(managed) + 1 - self.max_worktrees
+        for last_used, name in sorted(managed)[: max(excess, 0)]:
+            try:
+                worktree = self.repo.lookup_worktree(name)
+            except (KeyError, pygit2.GitError):
+                worktree = None
+
+            if worktree is not None:
+                current = os.path.realpath(self.repo.workdir or "")
+                if os.path.realpath(worktree.path) == current:
+                    continue
+                if not worktree.is_prunable:
+                    if not self.is_clean(worktree.path):
+                        continue
+                    shutil.rmtree(worktree.path)
+                worktree.prune(True)
+            del self.usage.data[name]
+        self.usage.save()